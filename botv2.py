@@ -1,11 +1,21 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import time
 import hashlib
 import json
 import requests
 import random
+import bisect
+import asyncio
+import aiohttp
+import concurrent.futures
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 settings = json.loads(open(".settings", "r").read())
 
@@ -13,10 +23,6 @@ BRAIN_URL = settings.get("brain_url")
 SECRET = settings.get("brain_secret")
 
 GAME_ID = "13726"
-PACKET_ID = 0
-SESSION_ID = ""
-
-ENTITIES = {}
 
 headers = {
   "Host": "api.braincloudservers.com",
@@ -28,67 +34,374 @@ headers = {
 basedata = {
   "gameId": GAME_ID,
   "messages": [],
-  "packetId": PACKET_ID,
-  "sessionId": SESSION_ID
+  "packetId": 0,
+  "sessionId": ""
 }
 
-def gen_data(message):
-    global PACKET_ID
-    global SESSION_ID
-    data = json.loads(json.dumps(basedata))
-    data['messages'].append(message)
-    data['sessionId'] = SESSION_ID
-    data['packetId'] = PACKET_ID
-    return data
-
-def get_headers(data):
-    signature = hashlib.md5(bytearray(json.dumps(data)+SECRET, "utf-8")).hexdigest()
-    my_headers = json.loads(json.dumps(headers))
-    my_headers["X-SIG"] = signature.upper()
-    return my_headers
+SECRET_BYTES = (SECRET or "").encode("utf-8")
 
-def dump_response(rdata):
-    return rdata
+# connection pool settings, shared by the blocking and the async client; the
+# keep-alive idle time only applies to aiohttp, requests has no such setting
+HTTP_POOL_SIZE = settings.get("http_pool_size", 10)
+HTTP_KEEPALIVE = settings.get("http_keepalive", 30)
+HTTP_CONNECT_TIMEOUT = settings.get("http_connect_timeout", 5)
+HTTP_READ_TIMEOUT = settings.get("http_read_timeout", 30)
+# seconds an async request may wait for a free pooled connection (and connect)
+HTTP_POOL_TIMEOUT = settings.get("http_pool_timeout", 30)
 
-def handle_response_login(rdata):
-    global SESSION_ID
-    global ENTITIES
+# packet ids are reserved in blocks of PACKET_ID_RESERVE: a saved session stores
+# the end of its block, so after a crash or restart it carries on past every id
+# it may have used, and brainCloud never mistakes a new packet for a retry
+PACKET_ID_RESERVE = settings.get("packet_id_reserve", 100)
 
-    open("logindata", "w").write(json.dumps(rdata, indent=2))
+# upper bound of messages per packet, until the login response tells us better
+MAX_BUNDLE_MSGS = settings.get("max_bundle_msgs", 10)
 
-    entities = rdata.get("entities")
-    player_name = rdata.get("playerName")
-    team_id = None
-    player_id = rdata.get("id")
+# seconds a cached team roster is trusted
+ROSTER_TTL = settings.get("roster_ttl", 60)
 
-    for ent in entities:
-        entType = ent.get("entityType")
-        ENTITIES[entType]=ent
-        if entType == "public":
-            team_id = ent.get("data").get("team_id")
+# team chat is read in windows of CHAT_WINDOW messages; a window that does not
+# reach back to the last handled message is fetched again, four times larger,
+# up to CHAT_HISTORY.
+CHAT_WINDOW = settings.get("chat_window", 25)
+CHAT_HISTORY = settings.get("chat_history", 1000)
 
-    SESSION_ID = rdata.get("sessionId")
-    return {
-        "sessionId": SESSION_ID,
-        "playerId": player_id,
-        "name": player_name,
-        "teamId": team_id
-    }
+# asset mirroring: chunk size of downloads and parallel downloads
+ASSET_CHUNK = 1024*1024
+ASSET_WORKERS = settings.get("asset_workers", 4)
 
-def send_request(message, response_handler=dump_response):
-    global PACKET_ID
-    req = gen_data(message)
-    headers = get_headers(req)
-    r = requests.post(BRAIN_URL, headers=headers, json=req)
-    PACKET_ID += 1
+# card pool paging; an incremental card pool sync falls back to a full one
+# when the last full sync is older than CARD_POOL_FULL_SYNC seconds
+CARD_PAGE_SIZE = 50
+CARD_POOL_FULL_SYNC = settings.get("card_pool_full_sync", 3600)
 
-    if (r.status_code != 200):
-        print("Error: Authentication failed")
-        print(r.text)
-        return None
+# last card pool per team: {"pool": ..., "synced": updatedAt, "full": time}
+card_pools = {}
+
+# reason codes brainCloud uses for expired, missing or logged out sessions
+SESSION_EXPIRED = (40303, 40304, 40356)
+
+# failed packets are sent again (the same bytes, so brainCloud can tell a
+# retry from a new packet) after a jittered, exponentially growing delay
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_ATTEMPTS = settings.get("retry_attempts", 3)
+RETRY_BASE_DELAY = settings.get("retry_base_delay", 0.5)
+RETRY_MAX_DELAY = settings.get("retry_max_delay", 8)
+
+# an endpoint that keeps failing is given a rest: after BREAKER_FAILURES failed
+# attempts in a row, requests fail right away for BREAKER_RESET seconds
+BREAKER_FAILURES = settings.get("breaker_failures", 5)
+BREAKER_RESET = settings.get("breaker_reset", 30)
+
+# both pools are created on first use; the aiohttp one has to live inside the event loop.
+# RTT websockets hold their connection while open, so they get a session of their own
+http_session = None
+aio_session = None
+rtt_session = None
+
+class BrainCloudError(Exception):
+    # brainCloud refused a request; retryable tells whether trying again later may help
+    def __init__(self, status, message, reason_code=None):
+        super().__init__("{}: {}".format(status, message))
+        self.status = status
+        self.message = message
+        self.reason_code = reason_code
+        self.retryable = status in RETRY_STATUSES
+
+class TransportError(BrainCloudError):
+    # no usable answer: connection error, timeout or an HTTP error status
+    def __init__(self, status, message, reason_code=None):
+        super().__init__(status, message, reason_code)
+        self.retryable = status is None or status in RETRY_STATUSES
+
+class CircuitOpen(TransportError):
+    pass
+
+class AuthenticationError(BrainCloudError):
+    pass
+
+class CircuitBreaker:
+    # Counts failed attempts against one endpoint. Once open, requests fail with
+    # CircuitOpen until the reset time has passed; then a single trial request
+    # is let through, and its outcome closes the breaker or opens it again.
+
+    def __init__(self, url, failures=BREAKER_FAILURES, reset=BREAKER_RESET):
+        self.url = url
+        self.max_failures = failures
+        self.reset = reset
+        self.failures = 0
+        self.opened = None
+
+    def check(self):
+        if self.opened is None:
+            return
+        if time.time()-self.opened < self.reset:
+            raise CircuitOpen(None, "{} failed {} times, waiting".format(self.url, self.failures))
+        self.opened = time.time()
+
+    def success(self):
+        self.failures = 0
+        self.opened = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            if self.opened is None:
+                print("Too many failures, pausing requests to "+self.url)
+            self.opened = time.time()
+
+breakers = {}
+
+def breaker_for(url):
+    if url not in breakers:
+        breakers[url] = CircuitBreaker(url)
+    return breakers[url]
+
+def retry_delay(attempt):
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY*2**attempt))
+
+class Session:
+    # One brainCloud account: its session id, packet counter and login entities.
+    # All operations take an optional session and fall back to DEFAULT_SESSION, so
+    # several accounts can be logged in (and used concurrently) at the same time.
+    # A session that knows its credentials logs in again by itself when brainCloud
+    # reports it expired, and replays the packet that was refused.
+
+    def __init__(self, email=None, password=None):
+        self.email = email
+        self.password = password
+        self.session_id = ""
+        self.packet_id = 0
+        # end of the saved block of packet ids, and what saves the session again
+        # once the block is used up (see save_sessions)
+        self.packet_reserved = 0
+        self.on_reserve = None
+        # called for every packet sent, e.g. to charge a request budget
+        self.on_packet = None
+        self.entities = {}
+        self.player_id = None
+        self.name = None
+        self.team_id = None
+        self.max_bundle_msgs = MAX_BUNDLE_MSGS
+        self.lock = None
+        # (operations, since) of the packet on its way, for watchdogs
+        self.in_flight = None
+
+    def get_lock(self):
+        # brainCloud expects the packets of one session in order, one at a time
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        return self.lock
+
+    def gen_packet(self, messages):
+        # a fresh envelope per packet; the messages are not copied, as the
+        # builders return new dicts on every call
+        if self.on_reserve and self.packet_reserved and self.packet_id >= self.packet_reserved:
+            self.on_reserve()
+        if self.on_packet:
+            self.on_packet()
+        data = dict(basedata, messages=list(messages), sessionId=self.session_id, packetId=self.packet_id)
+        self.packet_id += 1
+        self.in_flight = (", ".join("{}/{}".format(m.get("service"), m.get("operation")) for m in messages), time.time())
+        return data
+
+    def current_call(self):
+        if self.in_flight is None:
+            return None
+        operations, since = self.in_flight
+        return "{} (packet {}, {:.0f}s ago)".format(operations, self.packet_id-1, time.time()-since)
+
+    def handle_login(self, rdata):
+        open("logindata", "w").write(json.dumps(rdata, indent=2))
+
+        entities = rdata.get("entities")
+        team_id = None
+
+        self.entities = {}
+        for ent in entities:
+            entType = ent.get("entityType")
+            self.entities[entType]=ent
+            if entType == "public":
+                team_id = ent.get("data").get("team_id")
+
+        self.session_id = rdata.get("sessionId")
+        self.player_id = rdata.get("id")
+        self.name = rdata.get("playerName")
+        self.team_id = team_id
+        self.max_bundle_msgs = rdata.get("maxBundleMsgs", self.max_bundle_msgs)
+        return self.info()
+
+    def info(self):
+        return {
+            "sessionId": self.session_id,
+            "playerId": self.player_id,
+            "name": self.name,
+            "teamId": self.team_id
+        }
+
+    def dump(self):
+        # everything but the password, see save_sessions; reserves the next
+        # block of packet ids, as the stored packetId is where a restore resumes
+        self.packet_reserved = self.packet_id + PACKET_ID_RESERVE
+        return {
+            "sessionId": self.session_id,
+            "packetId": self.packet_reserved,
+            "playerId": self.player_id,
+            "name": self.name,
+            "teamId": self.team_id,
+            "maxBundleMsgs": self.max_bundle_msgs
+        }
+
+    def restore(self, data):
+        self.session_id = data.get("sessionId", "")
+        self.packet_id = data.get("packetId", 0)
+        # nothing of the restored block is ours yet, save before the first packet
+        self.packet_reserved = self.packet_id
+        self.player_id = data.get("playerId")
+        self.name = data.get("name")
+        self.team_id = data.get("teamId")
+        self.max_bundle_msgs = data.get("maxBundleMsgs", self.max_bundle_msgs)
+
+    def relogin(self):
+        self.session_id = ""
+        req = self.gen_packet([login_message(self.email, self.password)])
+        try:
+            status, data = deliver(*encode_packet(req))
+        finally:
+            self.in_flight = None
+        return self.handle_relogin(req, status, data)
+
+    async def async_relogin(self):
+        # the caller holds the session lock
+        self.session_id = ""
+        req = self.gen_packet([login_message(self.email, self.password)])
+        try:
+            status, data = await async_deliver(*encode_packet(req))
+        finally:
+            self.in_flight = None
+        return self.handle_relogin(req, status, data)
 
-    data=r.json()
+    def handle_relogin(self, req, status, data):
+        if (status != 200):
+            print("Error: Authentication failed")
+            print(data)
+            raise AuthenticationError(status, data)
+        try:
+            return handle_responses(req, data, self.handle_login)[0]
+        except BrainCloudError as e:
+            raise AuthenticationError(e.status, e.message, e.reason_code)
 
+    def ensure_login(self):
+        if not self.session_id:
+            self.relogin()
+        return self.info()
+
+    async def async_ensure_login(self):
+        async with self.get_lock():
+            if not self.session_id:
+                await self.async_relogin()
+        return self.info()
+
+    def exchange(self, messages):
+        # returns the packet and brainCloud's answer, raises TransportError
+        try:
+            req = self.gen_packet(messages)
+            status, data = deliver(*encode_packet(req))
+            if session_expired(data) and self.email:
+                print("Session expired, logging in again as "+self.email)
+                self.relogin()
+                req = self.gen_packet(messages)
+                status, data = deliver(*encode_packet(req))
+        finally:
+            self.in_flight = None
+        if (status != 200):
+            raise TransportError(status, data)
+        return req, data
+
+    async def async_exchange(self, messages):
+        # the caller holds the session lock
+        try:
+            req = self.gen_packet(messages)
+            status, data = await async_deliver(*encode_packet(req))
+            if session_expired(data) and self.email:
+                print("Session expired, logging in again as "+self.email)
+                await self.async_relogin()
+                req = self.gen_packet(messages)
+                status, data = await async_deliver(*encode_packet(req))
+        finally:
+            self.in_flight = None
+        if (status != 200):
+            raise TransportError(status, data)
+        return req, data
+
+DEFAULT_SESSION = Session()
+
+def session_expired(data):
+    if not isinstance(data, dict):
+        return False
+    return any(r.get("reason_code") in SESSION_EXPIRED for r in data.get("responses", [data]))
+
+# sessions survive restarts in an optional cache file, keyed by account email
+
+def load_sessions(path):
+    if not path:
+        return {}
+    try:
+        return json.load(open(path, "r"))
+    except (IOError, ValueError):
+        return {}
+
+def save_sessions(path, sessions):
+    if not path:
+        return
+    cache = {}
+    for session in sessions:
+        if session.email and session.session_id:
+            cache[session.email] = session.dump()
+    fd = open(path+".tmp", "w")
+    fd.write(json.dumps(cache, indent=2))
+    fd.close()
+    os.replace(path+".tmp", path)
+
+def gen_data(message, session=None):
+    return gen_packet([message], session)
+
+def gen_packet(messages, session=None):
+    return (session or DEFAULT_SESSION).gen_packet(messages)
+
+# A packet is serialized exactly once: the signature is computed over the very
+# bytes that go on the wire, so the body and X-SIG can not disagree, and retries
+# can send the same body again. orjson is used when installed.
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def loads(body):
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+def get_headers(body):
+    my_headers = dict(headers)
+    my_headers["X-SIG"] = hashlib.md5(body+SECRET_BYTES).hexdigest().upper()
+    return my_headers
+
+def encode_packet(req):
+    body = dumps(req)
+    return body, get_headers(body)
+
+def dump_response(rdata):
+    return rdata
+
+def handle_response_login(rdata, session=None):
+    return (session or DEFAULT_SESSION).handle_login(rdata)
+
+def response_error(r):
+    return BrainCloudError(r.get("status"), r.get("status_message"), r.get("reason_code"))
+
+def handle_responses(req, data, response_handler):
     responses = data["responses"]
 
     handled_responses = []
@@ -99,14 +412,215 @@ def send_request(message, response_handler=dump_response):
             print()
             print("Error: Request failed")
             print(r.get("status_message"))
-            sys.exit(1)
+            raise response_error(r)
 
         rdata = r.get("data")
         handled_responses.append(response_handler(rdata))
     return handled_responses
 
-def login(email, password):
-    login_message = {
+def route_responses(req, packet, data):
+    # packet is a list of (message, response_handler, future), in request order
+    for (message, response_handler, future), r in zip(packet, data["responses"]):
+        if (r.get("status") != 200):
+            print("Error: Request failed")
+            print(message.get("service"), message.get("operation"), r.get("status_message"))
+            future.set_exception(response_error(r))
+        else:
+            future.set_result(response_handler(r.get("data")))
+
+    fail_packet(packet, BrainCloudError(200, "no response in packet"))
+
+def batch_results(futures):
+    # the results of a sent batch, raising the first error instead
+    return [future.result() for future in futures]
+
+def fail_packet(packet, error):
+    for message, response_handler, future in packet:
+        if not future.done():
+            future.set_exception(error)
+
+def decode_error(status, body, text):
+    # brainCloud explains most refusals in a json body, keep it if there is one
+    try:
+        return status, loads(body)
+    except ValueError:
+        return status, text
+
+def post_packet(body, headers):
+    r = get_http_session().post(BRAIN_URL, headers=headers, data=body,
+                                timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    if (r.status_code != 200):
+        return decode_error(r.status_code, r.content, r.text)
+    return r.status_code, loads(r.content)
+
+def deliver(body, headers):
+    # post_packet with retries and the endpoint's circuit breaker; an answer with
+    # a non retryable status is returned as it is
+    breaker = breaker_for(BRAIN_URL)
+    attempt = 0
+    while True:
+        breaker.check()
+        try:
+            status, data = post_packet(body, headers)
+            error = TransportError(status, data) if status in RETRY_STATUSES else None
+        except requests.RequestException as e:
+            error = TransportError(None, str(e))
+        if error is None:
+            breaker.success()
+            return status, data
+        breaker.failure()
+        if attempt >= RETRY_ATTEMPTS:
+            raise error
+        print("Request failed ({}), retrying".format(error))
+        time.sleep(retry_delay(attempt))
+        attempt += 1
+
+def send_request(message, response_handler=dump_response, session=None):
+    req, data = (session or DEFAULT_SESSION).exchange([message])
+    return handle_responses(req, data, response_handler)
+
+def get_http_session():
+    global http_session
+    if http_session is None:
+        http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                                                pool_maxsize=HTTP_POOL_SIZE)
+        http_session.mount("https://", adapter)
+        http_session.mount("http://", adapter)
+    return http_session
+
+def close():
+    global http_session
+    if http_session is not None:
+        http_session.close()
+    http_session = None
+
+def get_aio_session():
+    global aio_session
+    if aio_session is None or aio_session.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=HTTP_KEEPALIVE)
+        timeout = aiohttp.ClientTimeout(connect=HTTP_POOL_TIMEOUT, sock_connect=HTTP_CONNECT_TIMEOUT,
+                                        sock_read=HTTP_READ_TIMEOUT)
+        aio_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return aio_session
+
+def get_rtt_session():
+    global rtt_session
+    if rtt_session is None or rtt_session.closed:
+        connector = aiohttp.TCPConnector(limit=0)
+        timeout = aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT)
+        rtt_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return rtt_session
+
+async def async_close():
+    global aio_session, rtt_session
+    close()
+    if aio_session is not None and not aio_session.closed:
+        await aio_session.close()
+    if rtt_session is not None and not rtt_session.closed:
+        await rtt_session.close()
+    aio_session = None
+    rtt_session = None
+
+async def async_post_packet(body, headers):
+    async with get_aio_session().post(BRAIN_URL, headers=headers, data=body) as r:
+        if (r.status != 200):
+            return decode_error(r.status, await r.read(), await r.text())
+        return r.status, loads(await r.read())
+
+async def async_deliver(body, headers):
+    breaker = breaker_for(BRAIN_URL)
+    attempt = 0
+    while True:
+        breaker.check()
+        try:
+            status, data = await async_post_packet(body, headers)
+            error = TransportError(status, data) if status in RETRY_STATUSES else None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = TransportError(None, str(e) or type(e).__name__)
+        if error is None:
+            breaker.success()
+            return status, data
+        breaker.failure()
+        if attempt >= RETRY_ATTEMPTS:
+            raise error
+        print("Request failed ({}), retrying".format(error))
+        await asyncio.sleep(retry_delay(attempt))
+        attempt += 1
+
+async def async_send_request(message, response_handler=dump_response, session=None):
+    session = session or DEFAULT_SESSION
+    async with session.get_lock():
+        req, data = await session.async_exchange([message])
+    return handle_responses(req, data, response_handler)
+
+class Batch:
+    # Collects operations and sends them together, up to the session's bundle limit
+    # per signed packet. add() returns a future that receives the handled response
+    # of that message, or a BrainCloudError if brainCloud rejected it or could not
+    # be reached.
+    #
+    #   batch = Batch(session)
+    #   members = batch.add(team_members_message(teamId))
+    #   chat = batch.add(team_chat_message(teamId))
+    #   await batch.async_send()
+    #   members.result(), chat.result()
+
+    def __init__(self, session=None):
+        self.session = session or DEFAULT_SESSION
+        self.pending = []
+
+    def add(self, message, response_handler=dump_response):
+        future = concurrent.futures.Future()
+        self.pending.append((message, response_handler, future))
+        return future
+
+    def take_packets(self):
+        pending, self.pending = self.pending, []
+        size = self.session.max_bundle_msgs
+        return [pending[i:i+size] for i in range(0, len(pending), size)]
+
+    def send(self):
+        futures = [future for message, response_handler, future in self.pending]
+        for packet in self.take_packets():
+            try:
+                req, data = self.session.exchange([message for message, response_handler, future in packet])
+            except BrainCloudError as e:
+                fail_packet(packet, e)
+                continue
+            route_responses(req, packet, data)
+        return futures
+
+    async def async_send(self):
+        futures = [future for message, response_handler, future in self.pending]
+        async with self.session.get_lock():
+            for packet in self.take_packets():
+                try:
+                    req, data = await self.session.async_exchange([message for message, response_handler, future in packet])
+                except BrainCloudError as e:
+                    fail_packet(packet, e)
+                    continue
+                route_responses(req, packet, data)
+        return futures
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.send()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.async_send()
+
+# == message builders ===============================================================
+
+def login_message(email, password):
+    return {
       "data": {
         "anonymousId": "",
         "authenticationToken": password,
@@ -136,11 +650,9 @@ def login(email, password):
       "operation": "AUTHENTICATE",
       "service": "authenticationV2"
       }
-    responses = send_request(login_message, handle_response_login)
-    return responses[0]
 
-def send_chat_message(teamId, message):
-    chat_message = {
+def chat_message(teamId, message):
+    return {
       "data": {
         "channelId": GAME_ID + ":gr:" + teamId,
         "content": {
@@ -156,263 +668,819 @@ def send_chat_message(teamId, message):
       "service": "chat"
     }
 
-    responses = send_request(chat_message)
-    return responses[0]
-
-def promote_player(teamId, playerId):
-    script_message =       {
+def script_message(scriptName, scriptData):
+    return {
       "data": {
-        "scriptData": {
-            "player_id": playerId,
-        },
-        "scriptName": "teams/PROMOTE_PLAYER",
+        "scriptData": scriptData,
+        "scriptName": scriptName,
       },
       "operation": "RUN",
       "service": "script"
     }
-    responses = send_request(script_message)
-    return responses[0]
 
-def demote_player(teamId, playerId):
-    script_message =       {
-      "data": {
-        "scriptData": {
-            "player_id": playerId,
-        },
-        "scriptName": "teams/DEMOTE_PLAYER",
-      },
-      "operation": "RUN",
-      "service": "script"
-    }
-    responses = send_request(script_message)
-    return responses[0]
+def promote_message(playerId):
+    return script_message("teams/PROMOTE_PLAYER", {"player_id": playerId})
 
-def boot_player(teamId, playerId):
-    script_message =       {
-      "data": {
-        "scriptData": {
-            "player_id": playerId,
-        },
-        "scriptName": "teams/BOOT_PLAYER",
-      },
-      "operation": "RUN",
-      "service": "script"
-    }
-    responses = send_request(script_message)
-    return responses[0]
+def demote_message(playerId):
+    return script_message("teams/DEMOTE_PLAYER", {"player_id": playerId})
+
+def boot_message(playerId):
+    return script_message("teams/BOOT_PLAYER", {"player_id": playerId})
 
-def get_team_members(teamId):
-    script_message =       {
+def team_members_message(teamId):
+    return {
       "data": {
         "groupId": teamId,
       },
       "operation": "READ_GROUP_MEMBERS",
       "service": "group"
     }
-    responses = send_request(script_message)
-    return responses[0]
 
-def get_team_chat(teamId):
-    script_message = {
+def team_chat_message(teamId, maxReturn=100):
+    return {
         "data": {
             "channelId": GAME_ID + ":gr:" + teamId,
-            "maxReturn": 100,
+            "maxReturn": maxReturn,
         },
         "operation": "GET_RECENT_CHAT_MESSAGES",
         "service": "chat"
     }
-    responses = send_request(script_message)
-    return responses[0].get("messages")
 
-def channel_connect(teamId):
-    script_message = {
+def channel_connect_message(teamId, maxReturn=1000):
+    return {
         "data": {
             "channelId": GAME_ID + ":gr:" + teamId,
-            "maxReturn": 1000
+            "maxReturn": maxReturn
         },
         "operation": "CHANNEL_CONNECT",
         "service": "chat"
     }
-    responses = send_request(script_message)
-    return responses[0]
 
-def get_player_info(playerId):
-    script_message = {
+def card_pool_message(teamid, page, since=None):
+    criteria = {
+        "entityType": "TRADING_CARD",
+        "groupId": teamid
+    }
+    if since:
+        criteria["updatedAt"] = {"$gt": since}
+    return {
+             "data": {
+                "context": {
+                   "pagination": {
+                      "pageNumber": page,
+                      "rowsPerPage": CARD_PAGE_SIZE
+                   },
+                   "searchCriteria": criteria,
+                   "sortCriteria": {
+                      "data.id": 1
+                   }
+                }
+             },
+             "operation": "READ_GROUP_ENTITIES_PAGE",
+             "service": "group"
+          }
+
+def rtt_connection_message():
+    return {
+        "data": {},
+        "operation": "REQUEST_CLIENT_CONNECTION",
+        "service": "rttRegistration"
+    }
+
+def file_info_message(assetId):
+    return {
         "data": {
-            "scriptData": {
-                "player_id": playerId,
-            },
-            "scriptName": "events/GET_PLAYER_INFO",
+            "filename": assetId,
+            "folderPath": "/"
         },
-        "operation": "RUN",
-        "service": "script"
+        "operation": "GET_FILE_INFO_SIMPLE",
+        "service": "globalFileV3"
     }
-    responses = send_request(script_message)
+
+TRADE_SCRIPTS = {
+    "sell": "teams/TRADE_SELL_CARD",
+    "buy": "teams/TRADE_BUY_CARD",
+}
+
+def trade_message(scriptName, cardId, cardType, count):
+    return script_message(scriptName, {
+        "CARD_ID": cardId,
+        "CARD_TYPE": cardType,
+        "COUNT": count,
+    })
+
+def friend_code_message(friendCode):
+    return script_message("friends/FRIEND_ADD_FRIEND", {
+        "fast_friend_token": "",
+        "friend_code": friendCode
+    })
+
+def search_teams_message(search):
+    return script_message("teams/TEAM_SEARCH_EVENT", {
+        "COUNTRY": "DE",
+        "NAME": search,
+        "REQUIRED_TROPHIES": -1
+    })
+
+# == response helpers, shared by the blocking and the async client =================
+
+def team_id_from_player_info(responses):
+    return responses[0].get("response", {}).get("player_public_data", {}).get("data", {}).get("team_id")
+
+def online_from_members(members, playerId):
+    for memberId, memberData in members.items():
+        if memberId == playerId:
+            return memberData.get("customData",{}).get("online", False)
+
+def add_card_page(card_pool, responses, found):
+    # found collects (type, id) of this fetch, to spot cards listed twice
+    more_results = True
+    for response in responses:
+        if 'results' in response:
+            if 'moreAfter' in response['results']:
+                if not response['results']['moreAfter']:
+                    more_results = False
+            if 'items' in response['results']:
+                for carditem in response['results']['items']:
+                    key = (carditem['data']['type'], int(carditem['data']['id']))
+                    if key in found:
+                        print('this card was already found')
+                    found.add(key)
+                    card_pool.setdefault(key[0], {})[key[1]] = int(carditem['data']['count'])
+    return more_results
+
+def trade_report(orders, futures):
+    # one entry per order: did the script run and succeed, and what it answered
+    report = []
+    for order, future in zip(orders, futures):
+        error = future.exception()
+        response = None if error else future.result()
+        report.append({
+            "order": order,
+            "ok": error is None and response.get("success", True) != False,
+            "response": response,
+            "error": str(error) if error else None
+        })
+    return report
+
+def card_pool_pages(responses):
+    # number of pages, from the total count the first page reports
+    for response in responses:
+        count = response.get('results', {}).get('count')
+        if count is not None:
+            return max(1, -(-count // CARD_PAGE_SIZE))
+    return None
+
+def card_pool_start(teamid, incremental):
+    cached = card_pools.get(teamid)
+    if incremental and cached and time.time()-cached["full"] < CARD_POOL_FULL_SYNC:
+        pool = {cardType: dict(cards) for cardType, cards in cached["pool"].items()}
+        return pool, cached["synced"], cached["full"]
+    return {'hat':{}, 'golfer': {}}, None, time.time()
+
+def card_pool_done(teamid, card_pool, responses, since, full):
+    synced = since or 0
+    for response in responses:
+        for carditem in response.get('results', {}).get('items', []):
+            synced = max(synced, carditem.get('updatedAt', 0))
+    card_pools[teamid] = {"pool": card_pool, "synced": synced, "full": full}
+    return card_pool
+
+def player_from_friend_code(response):
+    print(json.dumps(response, indent=2))
+    if response[0]["success"] == True:
+        return response[0].get("response").get("targetPlayer")
+    else:
+        return None
+
+def save_asset(assetId, r):
+    with open(assetId+".zip", 'wb') as f:
+        for chunk in r.iter_content(chunk_size=8192):
+            f.write(chunk)
+
+class Roster:
+    # Cached READ_GROUP_MEMBERS result of one team, indexed by player id and by
+    # lower-cased name. It goes stale after ROSTER_TTL seconds, or right away
+    # with invalidate() when a join, leave or boot shows up in the chat.
+    # Functions in listeners are called with the roster after every update;
+    # came_online then holds the players that were not online before it.
+
+    def __init__(self, teamId):
+        self.teamId = teamId
+        self.members = {}
+        self.names = []
+        self.fetched = 0
+        self.listeners = []
+        self.online_ids = set()
+        self.came_online = set()
+
+    def update(self, members):
+        self.members = members
+        self.names = sorted((data.get("playerName", "").lower(), playerId) for playerId, data in members.items())
+        online_ids = set(playerId for playerId, data in members.items() if (data.get("customData") or {}).get("online"))
+        self.came_online = online_ids - self.online_ids
+        self.online_ids = online_ids
+        self.fetched = time.time()
+        for listener in self.listeners:
+            listener(self)
+        return self
+
+    def age(self):
+        return time.time() - self.fetched
+
+    def stale(self):
+        return self.age() > ROSTER_TTL
+
+    def invalidate(self):
+        self.fetched = 0
+
+    def refresh(self, session=None):
+        return self.update(get_team_members(self.teamId, session=session))
+
+    async def async_refresh(self, session=None):
+        return self.update(await async_get_team_members(self.teamId, session=session))
+
+    def name(self, playerId):
+        return self.members.get(playerId, {}).get("playerName")
+
+    def find(self, search):
+        # player id first, then a name starting with search, then any name or id
+        # containing it
+        if search in self.members:
+            return search, self.name(search)
+        key = search.lower()
+        i = bisect.bisect_left(self.names, (key,))
+        if i < len(self.names) and self.names[i][0].startswith(key):
+            playerId = self.names[i][1]
+            return playerId, self.name(playerId)
+        for name, playerId in self.names:
+            if key in name or search in playerId:
+                return playerId, self.name(playerId)
+        return None, None
+
+    def online(self, playerId):
+        return playerId in self.online_ids
+
+def refresh_rosters(rosters, session=None):
+    # all rosters in as few packets as possible
+    batch = Batch(session)
+    pending = [(roster, batch.add(team_members_message(roster.teamId))) for roster in rosters]
+    batch.send()
+    for roster, future in pending:
+        if not future.exception():
+            roster.update(future.result())
+    return rosters
+
+async def async_refresh_rosters(rosters, session=None):
+    batch = Batch(session)
+    pending = [(roster, batch.add(team_members_message(roster.teamId))) for roster in rosters]
+    await batch.async_send()
+    for roster, future in pending:
+        if not future.exception():
+            roster.update(future.result())
+    return rosters
+
+def message_key(message):
+    # chat messages in the order they were written; msgIds grow per channel
+    try:
+        msgId = int(message.get("msgId"))
+    except (TypeError, ValueError):
+        msgId = 0
+    return message.get("date", 0), msgId
+
+class ChatCursor:
+    # How far the chat of one team has been handled: date and id of the newest
+    # handled message, and the ids of the handled messages of that same date, so
+    # messages sharing a timestamp are neither lost nor handled twice. Older
+    # messages are rejected by their date alone.
+    #
+    #   for message in cursor.new(messages):
+    #       ...
+    #       cursor.handled(message)
+
+    def __init__(self, date=0, msgId=0, seen=()):
+        self.date = date
+        self.msgId = msgId
+        self.seen = set(seen)
+
+    @classmethod
+    def restore(cls, data):
+        return cls(data.get("date", 0), data.get("msgId", 0), data.get("seen", []))
+
+    def dump(self):
+        return {"date": self.date, "msgId": self.msgId, "seen": sorted(self.seen)}
+
+    def is_new(self, message):
+        return message.get("date", 0) >= self.date and str(message.get("msgId")) not in self.seen
+
+    def new(self, messages):
+        return sorted((message for message in messages if self.is_new(message)), key=message_key)
+
+    def handled(self, message):
+        date = message.get("date", 0)
+        if date > self.date:
+            self.seen = set()
+        if date >= self.date:
+            self.seen.add(str(message.get("msgId")))
+        if message_key(message) > (self.date, self.msgId):
+            self.date, self.msgId = message_key(message)
+
+    def gap(self, messages, window):
+        # a full window that starts after the cursor may have missed messages
+        if not self.date or len(messages) < window:
+            return False
+        return min(message.get("date", 0) for message in messages) > self.date
+
+class ChatEvent:
+    # One team chat message, parsed once. content is the inner message with the
+    # type specific fields (promoted, demoted, booted, ...).
+    __slots__ = ("msgId", "date", "type", "text", "author", "authorId", "content")
+
+    def __init__(self, message):
+        sender = message.get("from") or {}
+        self.content = (message.get("content") or {}).get("message") or {}
+        self.msgId = message.get("msgId")
+        self.date = message.get("date", 0)
+        self.type = self.content.get("type", "chat")
+        self.text = self.content.get("msg")
+        self.author = sender.get("name")
+        self.authorId = sender.get("id")
+
+def fill_chat_gap(teamId, cursor, messages, window, session=None):
+    # fetches larger windows until they reach back to the cursor
+    while cursor.gap(messages, window) and window < CHAT_HISTORY:
+        window = min(window*4, CHAT_HISTORY)
+        messages = get_team_chat(teamId, session=session, maxReturn=window)
+    if cursor.gap(messages, window):
+        print("Team {} wrote more than {} messages since the last check, some are lost".format(teamId, window))
+    return messages
+
+async def async_fill_chat_gap(teamId, cursor, messages, window, session=None):
+    while cursor.gap(messages, window) and window < CHAT_HISTORY:
+        window = min(window*4, CHAT_HISTORY)
+        messages = await async_get_team_chat(teamId, session=session, maxReturn=window)
+    if cursor.gap(messages, window):
+        print("Team {} wrote more than {} messages since the last check, some are lost".format(teamId, window))
+    return messages
+
+# == blocking client ================================================================
+
+def login(email, password, session=None):
+    session = session or DEFAULT_SESSION
+    session.email = email
+    session.password = password
+    responses = send_request(login_message(email, password), session.handle_login, session)
+    return responses[0]
+
+def send_chat_message(teamId, message, session=None):
+    responses = send_request(chat_message(teamId, message), session=session)
+    return responses[0]
+
+def promote_player(teamId, playerId, session=None):
+    responses = send_request(promote_message(playerId), session=session)
+    return responses[0]
+
+def demote_player(teamId, playerId, session=None):
+    responses = send_request(demote_message(playerId), session=session)
     return responses[0]
 
-def is_player_online(playerId, teamId=None):
+def boot_player(teamId, playerId, session=None):
+    responses = send_request(boot_message(playerId), session=session)
+    return responses[0]
+
+def get_team_members(teamId, session=None):
+    responses = send_request(team_members_message(teamId), session=session)
+    return responses[0]
+
+def get_team_chat(teamId, session=None, maxReturn=100):
+    responses = send_request(team_chat_message(teamId, maxReturn), session=session)
+    return responses[0].get("messages")
+
+def channel_connect(teamId, session=None):
+    responses = send_request(channel_connect_message(teamId), session=session)
+    return responses[0]
+
+def get_player_info(playerId, session=None):
+    return send_request(script_message("events/GET_PLAYER_INFO", {"player_id": playerId}), session=session)
+
+def is_player_online(playerId, teamId=None, session=None):
     if not teamId:
-        data = get_player_info(playerId)
-        teamId = data.get("response", {}).get("player_public_data", {}).get("data", {}).get("team_id")
+        teamId = team_id_from_player_info(get_player_info(playerId, session=session))
 
     # I think we cannot say anything if the player doesn't have a team
     if not teamId:
         return False
 
-    members = get_team_members(teamId)
-    for memberId, memberData in members.items():
-        if memberId == playerId:
-            return memberData.get("customData",{}).get("online", False)
+    return online_from_members(get_team_members(teamId, session=session), playerId)
 
-def sell_card(cardId, cardType, count):
-    script_message = {
-        "data": {
-            "scriptData": {
-                "CARD_ID": cardId,
-                "CARD_TYPE": cardType,
-                "COUNT": count,
-            },
-            "scriptName": "teams/TRADE_SELL_CARD",
-        },
-        "operation": "RUN",
-        "service": "script"
-    }
-    responses = send_request(script_message)
+def sell_card(cardId, cardType, count, session=None):
+    responses = send_request(trade_message(TRADE_SCRIPTS["sell"], cardId, cardType, count), session=session)
     return responses[0]
 
-def buy_card(cardId, cardType, count):
-    script_message = {
-        "data": {
-            "scriptData": {
-                "CARD_ID": cardId,
-                "CARD_TYPE": cardType,
-                "COUNT": count,
-            },
-            "scriptName": "teams/TRADE_BUY_CARD",
-        },
-        "operation": "RUN",
-        "service": "script"
-    }
-    responses = send_request(script_message)
+def buy_card(cardId, cardType, count, session=None):
+    responses = send_request(trade_message(TRADE_SCRIPTS["buy"], cardId, cardType, count), session=session)
     return responses[0]
 
-def get_card_pool(teamid):
-    card_pool = {'hat':{}, 'golfer': {}}
-    page = 1
-    more_results = True
-    while(more_results):
-        script_message = {
-                 "data": {
-                    "context": {
-                       "pagination": {
-                          "pageNumber": page,
-                          "rowsPerPage": 50
-                       },
-                       "searchCriteria": {
-                          "entityType": "TRADING_CARD",
-                          "groupId": teamid
-                       },
-                       "sortCriteria": {
-                          "data.id": 1
-                       }
-                    }
-                 },
-                 "operation": "READ_GROUP_ENTITIES_PAGE",
-                 "service": "group"
-              }
-        responses = send_request(script_message)
-        page += 1
-        for response in responses:
-            if 'results' in response:
-                if 'moreAfter' in response['results']:
-                    if not response['results']['moreAfter']:
-                        more_results = False
-                if 'items' in response['results']:
-                    for carditem in response['results']['items']:
-                        if int(carditem['data']['id']) in card_pool[carditem['data']['type']]:
-                            print('this card was already found')
-                        card_pool[carditem['data']['type']][int(carditem['data']['id'])] = int(carditem['data']['count'])
-    return responses, card_pool
-
-def open_pack(packId):
-    request = {
-      "data": {
-        "scriptData": {
-          "slot_num": packId
-        },
-        "scriptName": "packs/OPEN_SLOT_PACK"
-      },
-      "operation": "RUN",
-      "service": "script"
-    }
-    responses = send_request(request)
+def get_card_pool(teamid, session=None, incremental=False):
+    # The first page tells how many pages there are, the others are then fetched
+    # together in bundled packets. incremental only fetches the cards that changed
+    # since the last sync of this team and merges them into the cached pool.
+    card_pool, since, full = card_pool_start(teamid, incremental)
+    found = set()
+    responses = send_request(card_pool_message(teamid, 1, since), session=session)
+    more_results = add_card_page(card_pool, responses, found)
+    pages = card_pool_pages(responses)
+    if pages is not None:
+        batch = Batch(session)
+        for page in range(2, pages+1):
+            batch.add(card_pool_message(teamid, page, since))
+        responses = responses + [future.result() for future in batch.send()]
+        add_card_page(card_pool, responses[1:], found)
+    else:
+        page = 2
+        while(more_results):
+            page_responses = send_request(card_pool_message(teamid, page, since), session=session)
+            page += 1
+            more_results = add_card_page(card_pool, page_responses, found)
+            responses = responses + page_responses
+    return responses, card_pool_done(teamid, card_pool, responses, since, full)
+
+def bulk_trade(orders, side="sell", session=None):
+    # Runs a list of (cardId, cardType, count) orders for the session's account,
+    # bundled into as few packets as brainCloud allows instead of one round trip
+    # per card. Returns a report per order and the team card pool afterwards
+    # (a full sync: an incremental one would not see the cards sold out). Packets
+    # of one session go out one after the other; async_bulk_trades runs several
+    # accounts concurrently.
+    session = session or DEFAULT_SESSION
+    batch = Batch(session)
+    futures = [batch.add(trade_message(TRADE_SCRIPTS[side], *order)) for order in orders]
+    batch.send()
+    report = trade_report(orders, futures)
+    responses, card_pool = get_card_pool(session.team_id, session)
+    return report, card_pool
+
+def open_pack(packId, session=None):
+    responses = send_request(script_message("packs/OPEN_SLOT_PACK", {"slot_num": packId}), session=session)
     return responses
 
-def get_player_by_friend_code(friendCode):
-    request = {
-      "data": {
-        "scriptData": {
-          "fast_friend_token": "",
-          "friend_code": friendCode
-        },
-        "scriptName": "friends/FRIEND_ADD_FRIEND"
-      },
-      "operation": "RUN",
-      "service": "script"
+def get_player_by_friend_code(friendCode, session=None):
+    return player_from_friend_code(send_request(friend_code_message(friendCode), session=session))
+
+def search_teams(search, session=None):
+    return send_request(search_teams_message(search), session=session)
+
+def download_file(assetId, session=None):
+    reply = send_request(file_info_message(assetId), session=session)
+
+    url = reply[0].get("fileDetails").get("url")
+    with get_http_session().get(url, stream=True,
+                                timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)) as r:
+        save_asset(assetId, r)
+    return True
+
+# == asset mirror ===================================================================
+# sync_assets keeps <folder>/<assetId>.zip up to date for many assets at once. The
+# file infos are resolved in bundled packets, unchanged files (same size and
+# version/date as recorded in <folder>/.assets.json) are skipped, and the rest
+# is downloaded by ASSET_WORKERS threads. Downloads go to a .part file and resume
+# with an HTTP range request after an interruption, if the asset did not change
+# in the meantime.
+
+def asset_manifest(folder):
+    try:
+        return json.load(open(os.path.join(folder, ".assets.json"), "r"))
+    except (IOError, ValueError):
+        return {}
+
+def asset_version(details):
+    return {
+        "fileSize": details.get("fileSize"),
+        "version": details.get("version"),
+        "dateUpdated": details.get("dateUpdated")
     }
-    response = send_request(request)
-    print(json.dumps(response, indent=2))
-    if response[0]["success"] == True:
-        return response[0].get("response").get("targetPlayer")
+
+def asset_unchanged(path, details, known):
+    return (os.path.exists(path)
+            and os.path.getsize(path) == details.get("fileSize")
+            and known == asset_version(details))
+
+def discard_part(part):
+    for leftover in (part, part+".json"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+def fetch_asset(path, details):
+    # <path>.part.json records which version of the asset <path>.part belongs
+    # to; a part of another version, or one that can not be right, starts over
+    part = path+".part"
+    version = asset_version(details)
+    size = details.get("fileSize")
+    offset = 0
+    if os.path.exists(part):
+        try:
+            known = json.load(open(part+".json", "r"))
+        except (IOError, ValueError):
+            known = None
+        offset = os.path.getsize(part)
+        if known != version or (size is not None and offset > size):
+            discard_part(part)
+            offset = 0
+    if not offset:
+        with open(part+".json", "w") as f:
+            f.write(json.dumps(version))
+    # a complete part file was interrupted before the rename, no need to ask again
+    if not offset or offset != size:
+        request_headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+        with get_http_session().get(details.get("url"), headers=request_headers, stream=True,
+                                    timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)) as r:
+            if r.status_code == 416:
+                # the part does not fit the file on the server after all
+                discard_part(part)
+                return fetch_asset(path, details)
+            r.raise_for_status()
+            # a 200 instead of 206 means the server ignored the range, start over
+            mode = "ab" if r.status_code == 206 else "wb"
+            with open(part, mode, buffering=ASSET_CHUNK) as f:
+                for chunk in r.iter_content(chunk_size=ASSET_CHUNK):
+                    f.write(chunk)
+    got = os.path.getsize(part)
+    if size is not None and got != size:
+        discard_part(part)
+        raise IOError("size mismatch, got {} of {} bytes".format(got, size))
+    if details.get("md5"):
+        digest = hashlib.md5()
+        with open(part, "rb") as f:
+            for chunk in iter(lambda: f.read(ASSET_CHUNK), b""):
+                digest.update(chunk)
+        if digest.hexdigest().lower() != details.get("md5").lower():
+            discard_part(part)
+            raise IOError("checksum mismatch")
+    os.replace(part, path)
+    discard_part(part)
+
+def sync_assets(assetIds, folder=".", session=None, workers=ASSET_WORKERS):
+    # returns {assetId: "skipped" | "downloaded" | "failed: <reason>"}
+    batch = Batch(session)
+    infos = [(assetId, batch.add(file_info_message(assetId))) for assetId in assetIds]
+    batch.send()
+
+    manifest = asset_manifest(folder)
+    report = {}
+    todo = []
+    for assetId, future in infos:
+        if future.exception():
+            report[assetId] = "failed: "+str(future.exception())
+            continue
+        details = future.result().get("fileDetails", {})
+        path = os.path.join(folder, assetId+".zip")
+        if asset_unchanged(path, details, manifest.get(assetId, {})):
+            report[assetId] = "skipped"
+        else:
+            todo.append((assetId, path, details))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        downloads = dict((pool.submit(fetch_asset, path, details), (assetId, details)) for assetId, path, details in todo)
+        for download in concurrent.futures.as_completed(downloads):
+            assetId, details = downloads[download]
+            if download.exception():
+                report[assetId] = "failed: "+str(download.exception())
+                continue
+            report[assetId] = "downloaded"
+            manifest[assetId] = asset_version(details)
+
+    fd = open(os.path.join(folder, ".assets.json.tmp"), "w")
+    fd.write(json.dumps(manifest, indent=2))
+    fd.close()
+    os.replace(os.path.join(folder, ".assets.json.tmp"), os.path.join(folder, ".assets.json"))
+    return report
+
+# == async client ===================================================================
+# same operations as above, but awaitable, so the discord event loop keeps running
+# while brainCloud answers
+
+async def async_login(email, password, session=None):
+    session = session or DEFAULT_SESSION
+    session.email = email
+    session.password = password
+    responses = await async_send_request(login_message(email, password), session.handle_login, session)
+    return responses[0]
+
+async def async_send_chat_message(teamId, message, session=None):
+    responses = await async_send_request(chat_message(teamId, message), session=session)
+    return responses[0]
+
+async def async_promote_player(teamId, playerId, session=None):
+    responses = await async_send_request(promote_message(playerId), session=session)
+    return responses[0]
+
+async def async_demote_player(teamId, playerId, session=None):
+    responses = await async_send_request(demote_message(playerId), session=session)
+    return responses[0]
+
+async def async_boot_player(teamId, playerId, session=None):
+    responses = await async_send_request(boot_message(playerId), session=session)
+    return responses[0]
+
+async def async_get_team_members(teamId, session=None):
+    responses = await async_send_request(team_members_message(teamId), session=session)
+    return responses[0]
+
+async def async_get_team_chat(teamId, session=None, maxReturn=100):
+    responses = await async_send_request(team_chat_message(teamId, maxReturn), session=session)
+    return responses[0].get("messages")
+
+async def async_channel_connect(teamId, session=None):
+    responses = await async_send_request(channel_connect_message(teamId), session=session)
+    return responses[0]
+
+async def async_get_player_info(playerId, session=None):
+    return await async_send_request(script_message("events/GET_PLAYER_INFO", {"player_id": playerId}), session=session)
+
+async def async_is_player_online(playerId, teamId=None, session=None):
+    if not teamId:
+        teamId = team_id_from_player_info(await async_get_player_info(playerId, session=session))
+
+    if not teamId:
+        return False
+
+    return online_from_members(await async_get_team_members(teamId, session=session), playerId)
+
+async def async_sell_card(cardId, cardType, count, session=None):
+    responses = await async_send_request(trade_message(TRADE_SCRIPTS["sell"], cardId, cardType, count), session=session)
+    return responses[0]
+
+async def async_buy_card(cardId, cardType, count, session=None):
+    responses = await async_send_request(trade_message(TRADE_SCRIPTS["buy"], cardId, cardType, count), session=session)
+    return responses[0]
+
+async def async_get_card_pool(teamid, session=None, incremental=False):
+    card_pool, since, full = card_pool_start(teamid, incremental)
+    found = set()
+    responses = await async_send_request(card_pool_message(teamid, 1, since), session=session)
+    more_results = add_card_page(card_pool, responses, found)
+    pages = card_pool_pages(responses)
+    if pages is not None:
+        batch = Batch(session)
+        for page in range(2, pages+1):
+            batch.add(card_pool_message(teamid, page, since))
+        responses = responses + [future.result() for future in await batch.async_send()]
+        add_card_page(card_pool, responses[1:], found)
     else:
-        return None
+        page = 2
+        while(more_results):
+            page_responses = await async_send_request(card_pool_message(teamid, page, since), session=session)
+            page += 1
+            more_results = add_card_page(card_pool, page_responses, found)
+            responses = responses + page_responses
+    return responses, card_pool_done(teamid, card_pool, responses, since, full)
 
-def get_player_info(playerId):
-    request = {
-      "data": {
-        "scriptData": {
-          "player_id": playerId
-        },
-        "scriptName": "events/GET_PLAYER_INFO"
-      },
-      "operation": "RUN",
-      "service": "script"
-    }
-    return send_request(request)
+async def async_bulk_trade(orders, side="sell", session=None):
+    session = session or DEFAULT_SESSION
+    batch = Batch(session)
+    futures = [batch.add(trade_message(TRADE_SCRIPTS[side], *order)) for order in orders]
+    await batch.async_send()
+    report = trade_report(orders, futures)
+    responses, card_pool = await async_get_card_pool(session.team_id, session)
+    return report, card_pool
 
-def search_teams(search):
-    request = {
-      "data": {
-        "scriptData": {
-          "COUNTRY": "DE",
-          "NAME": search,
-          "REQUIRED_TROPHIES": -1
-        },
-        "scriptName": "teams/TEAM_SEARCH_EVENT"
-      },
-      "operation": "RUN",
-      "service": "script"
-    }
-    return send_request(request)
+async def async_bulk_trades(plans, side="sell", concurrency=4):
+    # plans is a list of (session, orders); sessions trade side by side, at most
+    # concurrency of them at a time. returns [(report, card_pool)] in plan order
+    limit = asyncio.Semaphore(concurrency)
+    async def run(session, orders):
+        async with limit:
+            return await async_bulk_trade(orders, side, session)
+    return await asyncio.gather(*[run(session, orders) for session, orders in plans])
 
-def download_file(assetId):
-    request = {
-        "data": {
-            "filename": assetId,
-            "folderPath": "/"
-        },
-        "operation": "GET_FILE_INFO_SIMPLE",
-        "service": "globalFileV3"
-    }
-    reply = send_request(request)
+async def async_open_pack(packId, session=None):
+    return await async_send_request(script_message("packs/OPEN_SLOT_PACK", {"slot_num": packId}), session=session)
+
+async def async_get_player_by_friend_code(friendCode, session=None):
+    return player_from_friend_code(await async_send_request(friend_code_message(friendCode), session=session))
+
+async def async_search_teams(search, session=None):
+    return await async_send_request(search_teams_message(search), session=session)
+
+async def async_download_file(assetId, session=None):
+    reply = await async_send_request(file_info_message(assetId), session=session)
 
     url = reply[0].get("fileDetails").get("url")
-    with requests.get(url) as r:
+    async with get_aio_session().get(url) as r:
         with open(assetId+".zip", 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
+            async for chunk in r.content.iter_chunked(8192):
                 f.write(chunk)
     return True
 
+# == real-time (RTT) push ==========================================================
+
+class RttConnection:
+    # Websocket connection to brainCloud's RTT service for one session. Chat
+    # messages pushed for the subscribed teams are passed to on_message(teamId,
+    # message), shaped like the entries of get_team_chat. run() keeps the
+    # connection up and reconnects with backoff; connected tells whether pushes
+    # are currently arriving, synced is cleared on every (re)connect so the
+    # caller knows it has to poll once to catch up.
+    #
+    # may_connect, if given, is awaited before every (re)connect; while it returns
+    # False the account is left alone, so neither connecting nor the login it may
+    # need takes the session away from somebody playing on it.
+    #
+    # With url set (see fake-rtt.py) the brainCloud endpoint lookup and the
+    # channel subscription are skipped, which allows testing without brainCloud.
+
+    def __init__(self, session, teamIds, on_message, url=None, may_connect=None):
+        self.session = session
+        self.teamIds = teamIds
+        self.on_message = on_message
+        self.url = url
+        self.may_connect = may_connect
+        self.connected = False
+        self.synced = False
+
+    async def endpoint(self):
+        if self.url:
+            return self.url, {}
+        await self.session.async_ensure_login()
+        responses = await async_send_request(rtt_connection_message(), session=self.session)
+        info = responses[0]
+        endpoint = [e for e in info.get("endpoints", []) if e.get("protocol") == "ws"][0]
+        scheme = "wss" if endpoint.get("ssl") else "ws"
+        return "{}://{}:{}/".format(scheme, endpoint.get("host"), endpoint.get("port")), info.get("auth", {})
+
+    async def subscribe(self):
+        # raises the first refused subscription, so run() reconnects
+        if self.url:
+            return
+        batch = Batch(self.session)
+        for teamId in self.teamIds:
+            batch.add(channel_connect_message(teamId, 0))
+        batch_results(await batch.async_send())
+
+    async def run(self):
+        delay = 1
+        while True:
+            try:
+                if self.may_connect and not await self.may_connect():
+                    print("RTT connection waits, the account is in use")
+                else:
+                    await self.listen()
+                    delay = 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("RTT connection lost: "+str(e))
+            self.connected = False
+            self.synced = False
+            await asyncio.sleep(delay)
+            delay = min(delay*2, 60)
+
+    async def listen(self):
+        url, auth = await self.endpoint()
+        heartbeat = None
+        async with get_rtt_session().ws_connect(url) as ws:
+            await ws.send_json({
+                "operation": "CONNECT",
+                "service": "rtt",
+                "data": {
+                    "appId": GAME_ID,
+                    "profileId": self.session.player_id,
+                    "sessionId": self.session.session_id,
+                    "auth": auth,
+                    "system": {
+                        "protocol": "ws",
+                        "platform": "WEB"
+                    }
+                }
+            })
+            try:
+                async for msg in ws:
+                    if msg.type not in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                        break
+                    data = json.loads(msg.data)
+                    service = data.get("service")
+                    operation = data.get("operation")
+                    if service == "rtt" and operation == "CONNECT":
+                        await self.subscribe()
+                        self.connected = True
+                        seconds = data.get("data", {}).get("heartbeatSeconds", 30)
+                        heartbeat = asyncio.ensure_future(self.heartbeat(ws, seconds))
+                    elif service == "rtt" and operation == "DISCONNECT":
+                        break
+                    elif service == "chat" and operation == "INCOMING":
+                        message = data.get("data", {})
+                        teamId = message.get("chId", "").split(":gr:")[-1]
+                        if teamId in self.teamIds:
+                            self.on_message(teamId, message)
+            finally:
+                if heartbeat:
+                    heartbeat.cancel()
+
+    async def heartbeat(self, ws, seconds):
+        while True:
+            await asyncio.sleep(seconds)
+            await ws.send_json({"operation": "HEARTBEAT", "service": "rtt"})
+
 if __name__=="__main__":
     # EXAMLE USAGE
     # LOGIN
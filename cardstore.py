@@ -0,0 +1,135 @@
+import json
+import numpy as np
+
+# Card pools as numpy columns, for trade planning over one or several teams.
+#
+#   store = CardStore.from_pools({"Wolf Gang": pool, "Wolf Pack": pool2}, load_config())
+#   store.suggest_sells(keep={"common": 20, "rare": 10}, default=5)
+#   store.suggest_buys(minimum=1)
+#
+# pool is the second value returned by botv2.get_card_pool. cardconfig.json is
+# expected to list the cards per type ("hat"/"golfer", or "hats"/"golfers"),
+# either as {id: {...}} or as [{"id": ..., ...}]; "rarity" and "level" are taken
+# from each card when present. Cards in the config that a team does not have
+# get a row with count 0, so they show up as missing.
+
+CARD_TYPES = ['hat', 'golfer']
+
+def load_config(path='cardconfig.json'):
+    return json.load(open(path, 'r'))
+
+def config_cards(config):
+    # {(type, id): (rarity, level)}
+    cards = {}
+    for key, entries in (config or {}).items():
+        cardType = key[:-1] if key.endswith('s') and key[:-1] in CARD_TYPES else key
+        if cardType not in CARD_TYPES:
+            continue
+        if isinstance(entries, dict):
+            entries = entries.items()
+        else:
+            entries = [(entry.get('id'), entry) for entry in entries if isinstance(entry, dict)]
+        for cardId, entry in entries:
+            try:
+                cardId = int(cardId)
+            except (TypeError, ValueError):
+                continue
+            if not isinstance(entry, dict):
+                entry = {}
+            cards[(cardType, cardId)] = (entry.get('rarity'), entry.get('level'))
+    return cards
+
+class CardStore:
+    def __init__(self, teams, rarities, team, kind, card, count, rarity, level, known):
+        # team, kind and rarity hold indices into teams, CARD_TYPES and rarities;
+        # rarity and level are -1 where the config does not know the card
+        self.teams = teams
+        self.rarities = rarities
+        self.team = team
+        self.kind = kind
+        self.card = card
+        self.count = count
+        self.rarity = rarity
+        self.level = level
+        self.known = known
+
+    @classmethod
+    def from_pool(cls, card_pool, config=None, team=''):
+        return cls.from_pools({team: card_pool}, config)
+
+    @classmethod
+    def from_pools(cls, pools, config=None):
+        configured = config_cards(config)
+        rarities = sorted(set(str(rarity) for rarity, level in configured.values() if rarity is not None))
+        rarity_index = dict((rarity, i) for i, rarity in enumerate(rarities))
+        teams = list(pools.keys())
+
+        rows = []
+        for t, name in enumerate(teams):
+            counts = {}
+            for cardType, cards in pools[name].items():
+                for cardId, count in cards.items():
+                    counts[(cardType, int(cardId))] = count
+            for key in configured:
+                counts.setdefault(key, 0)
+            for (cardType, cardId), count in counts.items():
+                if cardType not in CARD_TYPES:
+                    continue
+                rarity, level = configured.get((cardType, cardId), (None, None))
+                rows.append((t, CARD_TYPES.index(cardType), cardId, count,
+                             rarity_index.get(str(rarity), -1) if rarity is not None else -1,
+                             level if isinstance(level, int) else -1,
+                             (cardType, cardId) in configured))
+
+        columns = list(zip(*rows)) if rows else [[]]*7
+        return cls(teams, rarities,
+                   np.array(columns[0], dtype=np.int32),
+                   np.array(columns[1], dtype=np.int8),
+                   np.array(columns[2], dtype=np.int64),
+                   np.array(columns[3], dtype=np.int64),
+                   np.array(columns[4], dtype=np.int32),
+                   np.array(columns[5], dtype=np.int32),
+                   np.array(columns[6], dtype=bool))
+
+    def __len__(self):
+        return len(self.card)
+
+    def per_rarity(self, value, default):
+        # value is a number, or {rarity: number} with default for the rest
+        if not isinstance(value, dict):
+            return np.full(len(self), value, dtype=np.int64)
+        table = np.array([value.get(rarity, default) for rarity in self.rarities]+[default], dtype=np.int64)
+        return table[self.rarity]
+
+    def surplus(self, keep, default=0):
+        # how many of each card exceed keep (0 where none do)
+        return np.maximum(self.count-self.per_rarity(keep, default), 0)
+
+    def shortfall(self, minimum, default=0):
+        # how many of each configured card are missing to reach minimum
+        return np.where(self.known, np.maximum(self.per_rarity(minimum, default)-self.count, 0), 0)
+
+    def missing(self):
+        return self.orders(np.where(self.known & (self.count == 0), 1, 0))
+
+    def suggest_sells(self, keep, default=0):
+        return self.orders(self.surplus(keep, default))
+
+    def suggest_buys(self, minimum, default=0):
+        return self.orders(self.shortfall(minimum, default))
+
+    def orders(self, amounts):
+        # {team: [(cardId, cardType, count)]} for every row with a positive amount,
+        # in the order botv2 trades expect them
+        plan = dict((name, []) for name in self.teams)
+        rows = np.nonzero(amounts > 0)[0]
+        rows = rows[np.lexsort((self.card[rows], self.kind[rows], self.team[rows]))]
+        for team, kind, card, amount in zip(self.team[rows], self.kind[rows], self.card[rows], amounts[rows]):
+            plan[self.teams[team]].append((int(card), CARD_TYPES[kind], int(amount)))
+        return plan
+
+    def totals(self):
+        # cards per team and type: {team: {type: count}}
+        sums = np.zeros((len(self.teams), len(CARD_TYPES)), dtype=np.int64)
+        np.add.at(sums, (self.team, self.kind), self.count)
+        return dict((name, dict(zip(CARD_TYPES, (int(n) for n in sums[t])))) for t, name in enumerate(self.teams))
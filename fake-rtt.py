@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# Local stand-in for brainCloud's RTT service. Point the relay at it with
+# "rtt_url": "ws://localhost:8765/" to push chat without brainCloud's RTT
+# endpoint (the relay still logs in to brainCloud for everything else), or see
+# rtt-demo.py for a run without brainCloud and Discord. Post chat messages into
+# a team channel with
+#
+#   curl -d '{"name": "Tester", "msg": "hello"}' localhost:8765/chat/<teamid>
+#
+# The JSON body may also carry "type" (chat, join, leave, ...) and "id".
+
+import sys
+import json
+import time
+from aiohttp import web, WSMsgType
+
+GAME_ID = "13726"
+HEARTBEAT_SECONDS = 30
+
+clients = set()
+msg_id = 0
+
+async def rtt(request):
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    clients.add(ws)
+    print("client connected")
+    try:
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                break
+            data = json.loads(msg.data)
+            if data.get("operation") == "CONNECT":
+                await ws.send_json({
+                    "service": "rtt",
+                    "operation": "CONNECT",
+                    "data": {
+                        "cxId": "fake-"+str(id(ws)),
+                        "heartbeatSeconds": HEARTBEAT_SECONDS
+                    }
+                })
+            elif data.get("operation") == "HEARTBEAT":
+                await ws.send_json({"service": "rtt", "operation": "HEARTBEAT"})
+    finally:
+        clients.discard(ws)
+        print("client disconnected")
+    return ws
+
+async def chat(request):
+    global msg_id
+    body = await request.json()
+    msg_id += 1
+    message = {
+        "chId": GAME_ID+":gr:"+request.match_info["teamId"],
+        "msgId": str(msg_id),
+        "ver": 1,
+        "date": int(time.time()*1000),
+        "from": {
+            "id": body.get("id", "fake-player"),
+            "name": body.get("name", "Tester"),
+            "pic": None
+        },
+        "content": {
+            "message": {
+                "msg": body.get("msg", ""),
+                "type": body.get("type", "chat")
+            },
+            "text": "message"
+        }
+    }
+    for ws in list(clients):
+        await ws.send_json({"service": "chat", "operation": "INCOMING", "data": message})
+    return web.json_response({"delivered": len(clients), "message": message})
+
+def make_app():
+    app = web.Application()
+    app.add_routes([web.get("/", rtt), web.post("/chat/{teamId}", chat)])
+    return app
+
+if __name__=="__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    web.run_app(make_app(), port=port)
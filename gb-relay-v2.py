@@ -9,9 +9,12 @@ import json
 import logging
 import logging.handlers
 import time
-import os
+import asyncio
+import aiohttp
+import collections
 
 import botv2 as bot
+from statejournal import StateJournal
 
 print("Starting GB Discord bot.")
 
@@ -27,7 +30,11 @@ def log_setup(settings):
     logger.setLevel(logging.INFO)
 
 settings = json.load(open('.settings','r'))
-state = json.load(open('.state','r'))
+# .state is a snapshot, changes go to the .state.journal write-ahead log
+journal = StateJournal('.state',
+                       sync_every=settings.get('state_sync_every', 20),
+                       compact_every=settings.get('state_compact_every', 1000))
+state = journal.load()
 teamoverride = json.load(open('teamoverrides.json', 'r'))
 fullconfig = json.load(open('cardconfig.json', 'r'))
 
@@ -43,14 +50,88 @@ relogins = 0
 checker_email = settings.get('checker-email')
 checker_password = settings.get('checker-password')
 
-is_running = False
-RATE_LIMIT = 120
+# a team that does not stop within this many seconds after being cancelled by
+# the watchdog is considered stuck for good, and the relay restarts itself
+STUCK_AFTER = settings.get('stuck_after', 600)
+# the relay loop ticks every POLL_TICK seconds and checks the teams that are due
+POLL_TICK = settings.get('poll_tick', 10)
+MIN_POLL = settings.get('min_poll_interval', 30)
+MAX_POLL = settings.get('max_poll_interval', 300)
+# brainCloud packets per minute for all teams. every packet a relay session
+# sends is charged, whatever sent it; scheduled checks wait while it is used up
+REQUEST_BUDGET = settings.get('requests_per_minute', 120)
+# relayed messages of different authors written within this many seconds are
+# grouped into one discord post; discord allows 10 embeds per post and
+# 5 posts per 2 seconds per webhook
+OUTBOX_WINDOW = settings.get('outbox_window', 30)
+MAX_EMBEDS = 10
+WEBHOOK_POSTS = 5
+WEBHOOK_PERIOD = 2.0
+# a post that fails for a passing reason (5xx, connection trouble) is tried
+# again after a delay that doubles up to OUTBOX_MAX_BACKOFF seconds
+OUTBOX_MAX_BACKOFF = 300
+# push mode, see start_rtt
+RTT = settings.get('rtt', False)
+RTT_URL = settings.get('rtt_url')
+# how many teams are checked at the same time, and how long one team may take
+MAX_CONCURRENT_TEAMS = settings.get('max_concurrent_teams', 4)
+TEAM_DEADLINE = settings.get('team_deadline', 90)
+# /notify messages for a player who does not come online within this many
+# seconds are dropped
+NOTIFY_TTL = settings.get('notify_ttl', 7*24*3600)
+# a queued action that keeps failing for other reasons than brainCloud being
+# unavailable is dropped after this many attempts
+ACTION_RETRIES = settings.get('action_retries', 5)
 
-def keep_state():
-    fd = open('.state','w')
-    fd.write(json.dumps(state, indent=2))
-    fd.close()
-    logger.info("State stored.")
+# every team is polled on its own interval: after activity or a queued discord
+# command it drops to MIN_POLL, every quiet check doubles it up to MAX_POLL.
+# all teams share a token bucket of REQUEST_BUDGET packets per minute; charge()
+# is called for every packet sent, and a due team only starts its check while
+# there is at least one token left for each check started on this tick.
+class PollSchedule:
+    def __init__(self):
+        self.interval = {}
+        self.due = {}
+        self.tokens = REQUEST_BUDGET
+        self.refilled = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(REQUEST_BUDGET, self.tokens + (now-self.refilled)*REQUEST_BUDGET/60.0)
+        self.refilled = now
+
+    def due_chats(self, chats):
+        self.refill()
+        now = time.time()
+        due = [chat for chat in chats if self.due.get(chat['name'], now) <= now]
+        due.sort(key=lambda chat: self.due.get(chat['name'], now))
+        picked = []
+        for chat in due:
+            if self.tokens-len(picked) < 1:
+                logger.info("Request budget exhausted, deferring {} teams.".format(len(due)-len(picked)))
+                break
+            picked.append(chat)
+        return picked
+
+    def charge(self):
+        self.refill()
+        self.tokens -= 1
+
+    def wake(self, channel):
+        for chat in settings.get('chats', []):
+            if str(chat.get('channel')) == str(channel):
+                self.interval[chat['name']] = MIN_POLL
+                self.due[chat['name']] = time.time()
+
+    def done(self, chat, activity):
+        name = chat['name']
+        if activity:
+            self.interval[name] = MIN_POLL
+        else:
+            self.interval[name] = min(self.interval.get(name, MIN_POLL)*2, MAX_POLL)
+        self.due[name] = time.time() + self.interval[name]
+
+schedule = PollSchedule()
 
 print("Configuration finished. Logging to log file.")
 
@@ -62,6 +143,13 @@ print("Ready.")
 @client.event
 async def on_ready():
     logger.info('We have logged in as {0.user}'.format(client))
+    if RTT and not rtt_connections:
+        start_rtt()
+    # pick up whatever was queued or left undelivered before a restart
+    for chat in settings.get('chats', []):
+        worker_for(chat).wake()
+        if state.get('outbox', {}).get(str(chat['channel'])):
+            outbox_for(await get_channel(chat), chat)
     check_chats.start()
 
 @client.event
@@ -85,7 +173,7 @@ async def reply(ctx, reply):
         await ctx.defer()
     await send_reply(ctx.channel.id, ctx.author.display_name, reply)
     with suppress(Exception):
-        await ctx.send(reply+"\nYour reply was queued and will be sent during the next relay.", delete_after=60.0)
+        await ctx.send(reply+"\nYour reply was queued and will be sent shortly.", delete_after=60.0)
 
 @slash.slash(name = "notify",
              description = "Notify a player when they are online.",
@@ -125,12 +213,17 @@ async def notify(ctx, player, message):
 async def announce(ctx, message):
     with suppress(Exception):
         await ctx.defer()
-    for chat in settings.get('chats',[]):
-        if chat.get('read_only'):
-            continue
-        await send_reply(chat.get('channel'), ctx.author.display_name, message)
+    chats = [chat for chat in settings.get('chats',[]) if not chat.get('read_only')]
+    # queued for all teams at once, then every team worker posts it right away
+    with journal.transaction():
+        for chat in chats:
+            queue_event(chat.get('channel'), reply_author(ctx.author.display_name), message)
+    # one batched presence probe for all teams, instead of one per worker
+    await probe_presence(chats)
+    for chat in chats:
+        wake_team(chat.get('channel'))
     with suppress(Exception):
-        await ctx.send(message+"\nYour announcement was queued and will be sent during the next relay.", delete_after=60.0)
+        await ctx.send(message+"\nYour announcement is on its way to {} teams.".format(len(chats)), delete_after=60.0)
 
 @slash.slash(name = "yellowcard",
              description = "Warn and demote a player / issue a yellow card.",
@@ -151,7 +244,7 @@ async def yellowcard(ctx, player):
             await ctx.defer()
         await store_warning(ctx.channel.id, player)
         with suppress(Exception):
-            await ctx.send("Your warning was queued and will be sent during the next relay.", delete_after=60.0)
+            await ctx.send("Your warning was queued and will be sent shortly.", delete_after=60.0)
 
 @slash.slash(name = "redcard",
              description = "Boot and block a player / issue a red card.",
@@ -172,7 +265,7 @@ async def redcard(ctx, player):
             await ctx.defer()
         await store_redcard(ctx.channel.id, player)
         with suppress(Exception):
-            await ctx.send("Your boot request was queued and will be sent during the next relay.", delete_after=60.0)
+            await ctx.send("Your boot request was queued and will be sent shortly.", delete_after=60.0)
 
 @slash.slash(name = "boot",
              description = "Boot a player without issuing a block.",
@@ -193,11 +286,14 @@ async def boot(ctx, player):
             await ctx.defer()
         await store_boot(ctx.channel.id, player)
         with suppress(Exception):
-            await ctx.send("Your boot request was queued and will be sent during the next relay.", delete_after=60.0)
+            await ctx.send("Your boot request was queued and will be sent shortly.", delete_after=60.0)
 
 # queue messages for delivery
+def reply_author(author):
+    return ":| "+str(author)+" (via discord) |:"
+
 async def send_reply(channel, author, reply):
-    await store_event(channel, ":| "+str(author)+" (via discord) |:", reply)
+    await store_event(channel, reply_author(author), reply)
 async def send_notify(channel, author, target, message):
     await store_event(channel, "!"+target, ":| "+str(author)+" (via discord, notifying "+target+") |:\n"+message)
 async def store_warning(channel, player):
@@ -208,25 +304,56 @@ async def store_boot(channel, player):
     await store_event(channel, "boot", player)
 
 async def store_event(channel, author, reply):
-    state['queued_messages']=state.get('queued_messages',{})
-    queue = state.get('queued_messages',{}).get(str(channel),[])
-    queue.append((author, str(reply)))
-    state['queued_messages'][str(channel)]=queue
-    keep_state()
+    queue_event(channel, author, reply)
+    wake_team(channel)
+
+def queue_event(channel, author, reply):
+    journal.append(['queued_messages', str(channel)], (author, str(reply)))
+
+def wake_team(channel):
+    schedule.wake(channel)
+    for chat in settings.get('chats', []):
+        if str(chat.get('channel')) == str(channel):
+            worker_for(chat).wake()
 
 # == server interaction =============================================================
 
-async def connect_as(user, passwd):
-    return bot.login(user, passwd)
-    # do we need to handle the reply?
+# one brainCloud session per relayed team, plus one for the checker account.
+# sessions are reused across cycles (and across restarts, if session_cache is set)
+session_cache = bot.load_sessions(settings.get('session_cache'))
+
+def restored_session(email, passwd):
+    session = bot.Session(email, passwd)
+    # saved again whenever its block of packet ids is used up
+    session.on_reserve = keep_sessions
+    session.on_packet = schedule.charge
+    if email in session_cache:
+        session.restore(session_cache[email])
+    return session
+
+checker_session = restored_session(checker_email, checker_password)
+sessions = {}
+
+def session_for(chat):
+    if chat['name'] not in sessions:
+        sessions[chat['name']] = restored_session(chat['email'], chat['pass'])
+    return sessions[chat['name']]
+
+def keep_sessions():
+    bot.save_sessions(settings.get('session_cache'), [checker_session]+list(sessions.values()))
+
+async def connect_as(session):
+    # only authenticate if we have no session yet; an expired one is renewed
+    # by botv2 when brainCloud refuses a request
+    return await session.async_ensure_login()
 
 # welcome or ban people
 welcomed={}
-async def welcome_and_promote(team_id, who, pid):
+def welcome_and_promote(team_id, who, pid, batch):
+    # the caller marks pid in welcomed once the batch went out
     if pid in welcomed:
         logger.info("Refusing to welcome {} twice.".format(who))
         return
-    welcomed[pid]=True
 
     redlist = state.get('redlist',[])
     if pid in redlist:
@@ -244,14 +371,13 @@ async def welcome_and_promote(team_id, who, pid):
 3.) Most of the chatting happens on our Discord server. Join us on ogy.de/WG
 4.) If you have any questions, just ask away""".format(who)
 
-    bot.send_chat_message(team_id, chatmessage_en)
-    bot.send_chat_message(team_id, chatmessage)
-
+    # both welcome messages and the boot travel in the batch of the check
+    batch.add(bot.chat_message(team_id, chatmessage_en))
+    batch.add(bot.chat_message(team_id, chatmessage))
     if pid in redlist:
-        action="BOOT_PLAYER"
-        bot.boot_player(team_id, pid)
+        batch.add(bot.boot_message(pid))
 
-async def warn_and_demote(team_id, who, pid, complaint):
+async def warn_and_demote(team_id, who, pid, complaint, session):
     compl_de = ""
     compl_en = ""
     if complaint:
@@ -265,199 +391,689 @@ schenke einem anderen Teammitglied einen Challenge-Sieg um die Warnung abzubauen
 After a complaint{}, you have been issued a yellow card. Please apologize on Discord, or forfeit
 another game against one of your team members to get rid of the warning""".format(who, compl_en)
 
-    bot.send_chat_message(team_id, chatmessage_en)
-    bot.send_chat_message(team_id, chatmessage)
-    bot.demote_player(team_id, pid)
+    batch = bot.Batch(session)
+    batch.add(bot.chat_message(team_id, chatmessage_en))
+    batch.add(bot.chat_message(team_id, chatmessage))
+    batch.add(bot.demote_message(pid))
+    bot.batch_results(await batch.async_send())
     logger.info("Sent warning")
 
-async def boot_and_block(team_id, pid):
+async def boot_and_block(team_id, pid, session):
     redlist = state.get('redlist',[])
     if not pid in redlist:
-        redlist.append(str(pid))
-    state['redlist']=redlist
-    keep_state()
-    bot.boot_player(team_id, pid)
-
-async def get_player_by_id_or_string(team_id, search):
-    team = bot.get_team_members(team_id)
-    for playerId, data in team.items():
-        if search in playerId or search in data['playerName']:
-            return playerId, data['playerName']
-    return None, None
+        journal.append(['redlist'], str(pid))
+    await bot.async_boot_player(team_id, pid, session=session)
 
-# get chat messages
-@tasks.loop(seconds=RATE_LIMIT)
-async def check_chats():
-    global is_running
-    global relogins
-
-    if is_running:
-        logger.warn("Not starting background task, still running.")
-        logger.warn("Instead, we just restart the service. It's about time")
-        os.system("systemctl restart gb-relay")
-        time.sleep(10)
-        logger.warn("Still alive")
+# cached team rosters, see botv2.Roster
+rosters = {}
+
+def roster_for(team_id):
+    if team_id not in rosters:
+        rosters[team_id] = bot.Roster(team_id)
+        rosters[team_id].listeners.append(notify_online)
+    return rosters[team_id]
+
+async def probe_presence(chats):
+    # the checker reads the rosters of all teams due for a check, and of all
+    # teams with pending notifications, in one batched pass; check_chat takes the
+    # online state of the relay account from there, and the roster listener
+    # sees who came online
+    notifications = state.get('notifications', {})
+    stale = {}
+    for chat in chats + [chat for chat in settings.get('chats', []) if notifications.get(chat['teamid'])]:
+        roster = roster_for(chat['teamid'])
+        if roster.stale():
+            stale[chat['teamid']] = roster
+    if not stale:
         return
-    is_running = True
-    logger.info("Starting background task")
+    try:
+        await connect_as(checker_session)
+        await bot.async_refresh_rosters(list(stale.values()), checker_session)
+    except Exception:
+        logger.exception("Presence probe failed, teams check on their own.")
 
-    chats = settings.get('chats')
-    for chat in chats:
-        player_info = None
-        team_info = None
-
-        logger.info("Checking "+chat['name'])
-        team_id = chat['teamid']
-        ignore_online = chat.get('ignore_online',0)
-        await connect_as(checker_email, checker_password)
-        if not ignore_online and bot.is_player_online(chat['playerid']):
-            logger.info("Player is online, skipping")
-            continue
+# how far each team's chat has been relayed, see botv2.ChatCursor
+cursors = {}
 
-        channel = await client.fetch_channel(chat['channel'])
-        if not channel:
-            logger.error("Could not retrieve channel id "+chat['channel'])
-            continue
+def cursor_for(team_id):
+    if team_id not in cursors:
+        if team_id in state.get('chat_cursor', {}):
+            cursors[team_id] = bot.ChatCursor.restore(state['chat_cursor'][team_id])
+        else:
+            # carry on after the date the relay used to keep; it had relayed
+            # everything up to and including that date
+            last_posted = state.get('last_posted_message', {}).get(team_id)
+            cursors[team_id] = bot.ChatCursor(last_posted+1 if last_posted else 0)
+    return cursors[team_id]
 
-        # login main account
-        player_info = await connect_as(chat['email'], chat['pass'])
-        logger.info("Logged in as "+player_info["playerId"])
+async def get_player_by_id_or_string(team_id, search, session):
+    roster = roster_for(team_id)
+    pid, pname = roster.find(search)
+    if not pid and roster.age() > POLL_TICK:
+        # maybe somebody joined since we last looked
+        await roster.async_refresh(session)
+        pid, pname = roster.find(search)
+    return pid, pname
 
-        if not player_info['sessionId']:
-            logger.error("Could not log in as "+chat['name'])
-            continue
+async def account_in_use(chat):
+    # somebody playing on the relay account would be logged out by the relay
+    if chat.get('ignore_online',0):
+        return False
+    roster = roster_for(chat['teamid'])
+    if roster.stale():
+        await connect_as(checker_session)
+        await roster.async_refresh(checker_session)
+    return roster.online(chat['playerid'])
 
-        authenticated = 'playerId' in player_info
-        if not authenticated:
-            logger.error("Could not authenticate.")
-            continue
+async def get_channel(chat):
+    return client.get_channel(int(chat['channel'])) or await client.fetch_channel(chat['channel'])
+
+# == push mode ======================================================================
+# with rtt enabled every team account keeps an RTT connection open. pushed chat
+# messages are buffered per team and the team is checked right away. the team
+# is only polled while its connection is down, or once after it (re)connected.
+
+pushed = {}
+rtt_connections = {}
 
-        logger.info("CHECK")
-
-        messages = state.get('queued_messages',{}).get(str(channel.id),[])
-        new_queue = []
-        if not chat.get('read_only'):
-          for msg in messages:
-            author, reply = msg # or event and player
-            if author == "yellow":
-                pid, pname = await get_player_by_id_or_string(team_id, reply)
-                if not pid:
-                    await channel.send("Could not find player by string '{}'.".format(reply))
-                    continue
-                logger.info("Sending warning to "+pname+" "+pid)
-                await warn_and_demote(team_id, pname, pid, "") #TODO: implement complainer
-            elif author == "red":
-                pid, pname = await get_player_by_id_or_string(team_id, reply)
-                if not pid:
-                    await channel.send("Could not find player by string '{}'.".format(reply))
-                    continue
-                await boot_and_block(team_id, pid)
-            elif author == "boot":
-                pid, pname = await get_player_by_id_or_string(team_id, reply)
-                if not pid:
-                    await channel.send("Could not find player by string '{}'.".format(reply))
-                    continue
-                bot.boot_player(team_id, pid)
-            elif author[0] == "!":
-                pid, pname = await get_player_by_id_or_string(team_id, author[1:])
-                if not pid:
-                    await channel.send("Could not find player by string '{}'.".format(author[1:]))
-                    continue
-                if await is_player_online(pid):
-                    bot.send_chat_message(team_id, reply)
-                else:
-                    new_queue.append(msg)
+def on_push(team_id, message):
+    pushed.setdefault(team_id, []).append(message)
+    for chat in settings.get('chats', []):
+        if chat['teamid'] == team_id:
+            spawn_team(chat)
+
+def rtt_gate(chat):
+    # like check_chat, never log in on an account somebody is playing on
+    async def may_connect():
+        return not await account_in_use(chat)
+    return may_connect
+
+def start_rtt():
+    for chat in settings.get('chats', []):
+        connection = bot.RttConnection(session_for(chat), [chat['teamid']], on_push, RTT_URL, rtt_gate(chat))
+        rtt_connections[chat['name']] = connection
+        asyncio.ensure_future(connection.run())
+
+# == discord delivery ===============================================================
+
+# the impersonation webhook of every channel, looked up once and reused
+webhooks = {}
+
+async def get_webhook(channel):
+    if channel.id not in webhooks:
+        hook_name = 'gb-'+str(channel.id)
+        temp_webhook = None
+        for hook in await channel.webhooks():
+            if hook.name == hook_name:
+                temp_webhook = hook
+                break
+        if not temp_webhook:
+            temp_webhook = await channel.create_webhook(name = hook_name)
+        webhooks[channel.id] = temp_webhook
+    return webhooks[channel.id]
+
+async def send_as(channel, embeds, author):
+    temp_webhook = await get_webhook(channel)
+    try:
+        await temp_webhook.send(embeds=embeds, username=author)
+    except (discord.NotFound, discord.Forbidden):
+        # somebody deleted or changed the webhook, look it up again
+        logger.warning("Webhook for channel {} is gone, recreating it.".format(channel.id))
+        del webhooks[channel.id]
+        temp_webhook = await get_webhook(channel)
+        await temp_webhook.send(embeds=embeds, username=author)
+
+# Relayed messages are not sent inline: check_chat puts them into the outbox of
+# the channel and carries on, a background task per channel delivers them.
+# Pending posts wait in state['outbox'][channel] as [author, text, colour, date]
+# and are journaled together with the chat cursor, so a crash or restart
+# delivers them afterwards instead of losing them; an entry is only removed
+# once discord has it. Consecutive messages of one author, or of several
+# authors within OUTBOX_WINDOW seconds, go out as one post with up to
+# MAX_EMBEDS embeds (mixed posts carry the author in each embed and the team
+# name as username). Posts are spaced to stay within the webhook bucket, and a
+# 429 is waited out. Posts that fail for a passing reason are retried with
+# backoff; only a permanent refusal (any other 4xx) drops them.
+class Outbox:
+    def __init__(self, channel, name):
+        self.channel = channel
+        self.name = name
+        self.path = ['outbox', str(channel.id)]
+        self.posted = collections.deque()
+        self.wakeup = asyncio.Event()
+        self.backoff = WEBHOOK_PERIOD
+        if self.queued():
+            self.wakeup.set()
+        self.task = asyncio.ensure_future(self.drain())
+
+    def queued(self):
+        return state.get('outbox', {}).get(self.path[1], [])
+
+    def put(self, author, text, colour, when):
+        # inside a journal transaction the entry only shows up when it ends,
+        # which is before drain gets to run again
+        journal.append(self.path, [author, text, colour, when])
+        self.wakeup.set()
+
+    def take_group(self):
+        # the leading entries that go out as one post, and how many they are
+        queued = self.queued()
+        author, text, colour, when = queued[0]
+        group = [queued[0]]
+        last = when
+        for entry in queued[1:MAX_EMBEDS]:
+            if entry[0] != author and entry[3]-last > OUTBOX_WINDOW*1000:
+                break
+            group.append(entry)
+            last = entry[3]
+        embeds = [discord.Embed(colour=colour, description=text) for author, text, colour, when in group]
+        if len(set(entry[0] for entry in group)) == 1:
+            return group[0][0], embeds, len(group)
+        for entry, embed in zip(group, embeds):
+            embed.set_author(name=entry[0])
+        return self.name, embeds, len(group)
+
+    def unqueue(self, count):
+        # entries are only appended while we post, so the first count are ours
+        journal.set(self.path, self.queued()[count:])
+
+    async def throttle(self):
+        while len(self.posted) >= WEBHOOK_POSTS:
+            wait = self.posted[0]+WEBHOOK_PERIOD-time.time()
+            if wait <= 0:
+                self.posted.popleft()
             else:
-                bot.send_chat_message(team_id, "{}\n{}".format(author, reply))
+                await asyncio.sleep(wait)
+
+    async def retry_later(self, count, reason):
+        logger.warning("Could not relay {} messages to channel {} ({}), retrying in {}s.".format(count, self.channel.id, reason, self.backoff))
+        await asyncio.sleep(self.backoff)
+        self.backoff = min(self.backoff*2, OUTBOX_MAX_BACKOFF)
+
+    async def drain(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.queued():
+                username, embeds, count = self.take_group()
+                await self.throttle()
+                self.posted.append(time.time())
+                try:
+                    await send_as(self.channel, embeds, username)
+                    self.backoff = WEBHOOK_PERIOD
+                    self.unqueue(count)
+                except discord.HTTPException as e:
+                    if e.status == 429:
+                        retry_after = getattr(e, 'retry_after', None) or WEBHOOK_PERIOD
+                        logger.warning("Rate limited in channel {}, retrying in {}s.".format(self.channel.id, retry_after))
+                        await asyncio.sleep(retry_after)
+                    elif e.status >= 500:
+                        await self.retry_later(count, e.status)
+                    else:
+                        logger.exception("Dropping {} messages for channel {}.".format(count, self.channel.id))
+                        self.unqueue(count)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    await self.retry_later(count, str(e) or type(e).__name__)
+                except Exception:
+                    logger.exception("Could not relay {} messages to channel {}.".format(count, self.channel.id))
+                    self.unqueue(count)
+
+outboxes = {}
 
-        state['queued_messages']=state.get('queued_messages',{})
-        state['queued_messages'][str(channel.id)]=new_queue
-        keep_state()
+def outbox_for(channel, chat):
+    if channel.id not in outboxes:
+        outboxes[channel.id] = Outbox(channel, chat['name'])
+    return outboxes[channel.id]
+
+# == action queue ===================================================================
+# Discord commands wait in state['queued_messages'][channel] as (author, reply).
+# Every team has a worker that handles them as soon as they are queued instead
+# of with the next check, the most urgent first: red cards, boots and the
+# welcome (or boot) of players who joined, then warnings, then replies. A
+# /notify is resolved to a player id once and then waits in
+# state['notifications'][team][player id] as [message, queued at]. Roster
+# refreshes only look at the players who just came online, so pending
+# notifications cost nothing until their player shows up. Whatever is due for
+# a team is then posted in one batch.
+
+def priority(author):
+    if author in ('red', 'boot', 'welcome'):
+        return 0
+    if author == 'yellow':
+        return 1
+    if author[:1] == '!':
+        return 3
+    return 2
+
+async def handle_action(chat, channel, author, reply, session):
+    team_id = chat['teamid']
+    if author == 'welcome':
+        await welcome(team_id, reply, session)
+        return
+    if author not in ('yellow', 'red', 'boot') and author[:1] != '!':
+        await bot.async_send_chat_message(team_id, "{}\n{}".format(author, reply), session=session)
+        return
+    search = author[1:] if author[:1] == '!' else reply
+    pid, pname = await get_player_by_id_or_string(team_id, search, session)
+    if not pid:
+        await channel.send("Could not find player by string '{}'.".format(search))
+    elif author == "yellow":
+        logger.info("Sending warning to "+pname+" "+pid)
+        await warn_and_demote(team_id, pname, pid, "", session) #TODO: implement complainer
+    elif author == "red":
+        await boot_and_block(team_id, pid, session)
+    elif author == "boot":
+        await bot.async_boot_player(team_id, pid, session=session)
+    else:
+        journal.append(['notifications', team_id, pid], [reply, time.time()])
+        if roster_for(team_id).online(pid):
+            worker_for(chat).notify_due.add(pid)
+
+async def welcome(team_id, pid, session):
+    pid, pname = await get_player_by_id_or_string(team_id, pid, session)
+    if not pid:
+        logger.info("Player left before being welcomed.")
+        return
+    logger.info("promoting or banning {}.".format(pname))
+    batch = bot.Batch(session)
+    welcome_and_promote(team_id, pname, pid, batch)
+    bot.batch_results(await batch.async_send())
+    welcomed[pid]=True
+
+def notify_online(roster):
+    # roster listener: wake the worker if somebody with notifications came online
+    pending = state.get('notifications', {}).get(roster.teamId, {})
+    due = [pid for pid in roster.came_online if pid in pending]
+    if not due:
+        return
+    for chat in settings.get('chats', []):
+        if chat['teamid'] == roster.teamId:
+            worker_for(chat).notify_due.update(due)
+            worker_for(chat).wake()
+
+last_expiry = 0
+
+def expire_notifications():
+    # at most once an hour, drop notifications older than NOTIFY_TTL
+    global last_expiry
+    now = time.time()
+    if now-last_expiry < 3600:
+        return
+    last_expiry = now
+    for team_id, pending in list(state.get('notifications', {}).items()):
+        for pid, entries in list(pending.items()):
+            fresh = [entry for entry in entries if now-entry[1] < NOTIFY_TTL]
+            if not fresh:
+                logger.info("Dropping {} expired notifications for {}.".format(len(entries), pid))
+                journal.remove(['notifications', team_id, pid])
+            elif len(fresh) < len(entries):
+                journal.set(['notifications', team_id, pid], fresh)
 
-        messages = None
+class TeamWorker:
+    def __init__(self, chat):
+        self.chat = chat
+        self.queue_path = ['queued_messages', str(chat['channel'])]
+        self.wakeup = asyncio.Event()
+        self.retry = None
+        # players with notifications who were seen coming online
+        self.notify_due = set()
+        # failed attempts per queued (author, reply)
+        self.failures = {}
+        self.task = asyncio.ensure_future(self.run())
+
+    def wake(self):
+        self.wakeup.set()
+
+    def retry_later(self):
+        if self.retry is None:
+            self.retry = asyncio.get_event_loop().call_later(MIN_POLL, self.retry_now)
+
+    def retry_now(self):
+        self.retry = None
+        self.wake()
+
+    def queued(self):
+        return state.get('queued_messages', {}).get(self.queue_path[1], [])
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.work(), timeout=TEAM_DEADLINE)
+            except asyncio.TimeoutError:
+                logger.error("Queued actions for {} took longer than {}s. Waiting for: {}".format(self.chat['name'], TEAM_DEADLINE, in_flight(self.chat['name'])))
+                self.retry_later()
+            except Exception:
+                logger.exception("Queued actions for {} failed.".format(self.chat['name']))
+                self.retry_later()
+
+    async def work(self):
+        chat = self.chat
+        queue = list(self.queued())
+        if not queue and not self.notify_due:
+            return
+        if chat.get('read_only'):
+            self.unqueue(queue, range(len(queue)))
+            return
+        if await account_in_use(chat):
+            logger.info("Player is online, {} queued actions wait".format(len(queue)))
+            self.retry_later()
+            return
+
+        channel = await get_channel(chat)
+        session = session_for(chat)
+        await connect_as(session)
+        done = []
         try:
-            messages = bot.get_team_chat(team_id)
-        except:
-            messages = bot.channel_connect(team_id)
+            for i in sorted(range(len(queue)), key=lambda i: (priority(queue[i][0]), i)):
+                author, reply = queue[i]
+                try:
+                    await handle_action(chat, channel, author, reply, session)
+                except bot.BrainCloudError as e:
+                    if e.retryable or isinstance(e, (bot.AuthenticationError, bot.CircuitOpen)):
+                        # brainCloud is having a moment, or the account can not
+                        # log in; keep this and the rest for later
+                        logger.error("Could not handle queued {} for {}: {}".format(author, chat['name'], e))
+                        self.retry_later()
+                        break
+                    logger.error("Dropping queued {} for {}: {}".format(author, chat['name'], e))
+                except discord.HTTPException as e:
+                    if e.status < 500 and e.status != 429:
+                        logger.error("Dropping queued {} for {}: {}".format(author, chat['name'], e))
+                    elif not self.give_up(author, reply, e):
+                        break
+                except Exception as e:
+                    logger.exception("Queued {} for {} failed.".format(author, chat['name']))
+                    if not self.give_up(author, reply, e):
+                        break
+                self.failures.pop((author, reply), None)
+                done.append(i)
+        finally:
+            # whatever was carried out must not run again, even if we fail or time out
+            self.unqueue(queue, done)
+        await self.notify(session)
 
-        to_handle = []
-        last_posted_message=state.get('last_posted_message', {})
-        newest = last_posted_message.get(team_id,0)
+    def give_up(self, author, reply, error):
+        # counts a failed attempt; keeps the entry (and the rest) for later
+        # until it failed ACTION_RETRIES times
+        attempts = self.failures.get((author, reply), 0)+1
+        if attempts >= ACTION_RETRIES:
+            logger.error("Dropping queued {} for {} after {} attempts: {}".format(author, self.chat['name'], attempts, error))
+            return True
+        self.failures[(author, reply)] = attempts
+        logger.error("Could not handle queued {} for {} (attempt {}): {}".format(author, self.chat['name'], attempts, error))
+        self.retry_later()
+        return False
 
-        # todo, use a filter instead
-        for message in messages:
-            if message['date'] <= newest:
-                continue
-            to_handle.append(message)
-        to_handle.sort(key=lambda x: x['date'], reverse=False)
-
-        joined={}
-        for message in to_handle:
-            chatmsg = message.get('content',{}).get('message')
-            postmsg = chatmsg.get('msg')
-            when = message.get('date')
-            author = message.get("from",{}).get("name")
-            authorId = message.get("from",{}).get("id")
-
-            if chatmsg['type']=='leave':
-                postmsg = chatmsg['msg']+' left the team.'
-                if chatmsg['msg'] in joined:
-                   del joined[chatmsg['msg']]
-            if chatmsg['type']=='promote':
-                if not "promoted" in chatmsg:
-                    continue
-                postmsg = author+' has promoted '+chatmsg['promoted']+"."
-                if chatmsg['promoted'] in joined:
-                    del joined[chatmsg['promoted']]
-            if chatmsg['type']=='demote':
-                if not "demoted" in chatmsg:
-                    continue
-                postmsg = author+' has demoted '+chatmsg['demoted']+"."
-            if chatmsg['type']=='boot':
-                postmsg = author+' has booted '+chatmsg['booted']+"."
-            if chatmsg['type']=='join':
-                postmsg = author+' joined the team. (player id: '+message.get("from",{}).get("id")+')'
-                joined[author]=authorId
-            if chatmsg['type']=='friendly_match':
+    def unqueue(self, queue, done):
+        # entries are only appended while we work, so the indices still hold
+        if not done:
+            return
+        done = set(done)
+        journal.set(self.queue_path, [entry for i, entry in enumerate(self.queued()) if i not in done])
+
+    async def notify(self, session):
+        team_id = self.chat['teamid']
+        pending = state.get('notifications', {}).get(team_id, {})
+        due = [pid for pid in self.notify_due if pid in pending]
+        self.notify_due.clear()
+        if not due:
+            return
+        batch = bot.Batch(session)
+        for pid in due:
+            batch.add(bot.chat_message(team_id, "\n".join(reply for reply, queued in pending[pid])))
+        for pid, future in zip(due, await batch.async_send()):
+            error = future.exception()
+            if error is not None and error.retryable:
+                logger.error("Could not notify {} in {}: {}".format(pid, self.chat['name'], error))
+                self.notify_due.add(pid)
+                self.retry_later()
                 continue
-                #postmsg = author+' started a friendly match.'
-
-            to_discord = "{}".format(postmsg)
-
-            # use webhook for impersonation
-            webhooks = await channel.webhooks()
-            temp_webhook = None
-            hook_name = 'gb-'+str(channel.id)
-            for hook in webhooks:
-                if hook.name == hook_name:
-                    temp_webhook = hook
-                    break
-            if not temp_webhook:
-                temp_webhook = await channel.create_webhook(name = hook_name)
-            colour = int(chat.get('colour', '0xffffff'), 16)
-            if to_discord:
-                embed = discord.Embed(colour=colour, description=to_discord)
-                await temp_webhook.send(embed=embed, username=author)
-
-            if chatmsg['type']=='join':
-                time.sleep(0.1)
-                pretty = bot.pretty_print_player_info(authorId, author)
-                embed2 = discord.Embed(colour=colour, description=pretty)
-                #await temp_webhook.send(embed=embed2, username=author)
-                bot.send_chat_message(team_id, pretty)
-
-            last_posted_message[team_id] = when
-            state['last_posted_message'] = last_posted_message
-            keep_state()
-
-        if not chat.get('read_only'):
-           for join in set(joined.keys()):
-             logger.info("promoting or banning {}.".format(join))
-             await welcome_and_promote(team_id, join, joined[join])
-
-        logger.info("Finished checking "+chat['name'])
-    logger.info("Finished background task.")
-
-    is_running = False
-
-client.run(settings.get('token'))
+            if error is not None:
+                logger.error("Dropping notifications for {} in {}: {}".format(pid, self.chat['name'], error))
+            journal.remove(['notifications', team_id, pid])
+
+workers = {}
+
+def worker_for(chat):
+    if chat['name'] not in workers:
+        workers[chat['name']] = TeamWorker(chat)
+    return workers[chat['name']]
+
+# == chat events ====================================================================
+# Every new chat message is parsed once into a botv2.ChatEvent and dispatched to
+# the handler registered for its type; types without a handler are relayed like
+# chat. A handler returns the text for discord (or None) and notes in-game
+# follow-ups in the TeamActions of the check. Joined players are welcomed (or
+# booted) through the action queue, queued together with the new cursor.
+
+ROSTER_EVENTS = ('join', 'leave', 'boot', 'promote', 'demote')
+
+class TeamActions:
+    def __init__(self):
+        # joined players still to be welcomed, by name
+        self.joined = {}
+        self.roster_changed = False
+
+event_handlers = {}
+
+def handles(*event_types):
+    def register(handler):
+        for event_type in event_types:
+            event_handlers[event_type] = handler
+        return handler
+    return register
+
+@handles('chat')
+def on_chat(event, actions):
+    return event.text
+
+@handles('join')
+def on_join(event, actions):
+    actions.joined[event.author] = event.authorId
+    return event.author+' joined the team. (player id: '+event.authorId+')'
+
+@handles('leave')
+def on_leave(event, actions):
+    actions.joined.pop(event.text, None)
+    return event.text+' left the team.'
+
+@handles('promote')
+def on_promote(event, actions):
+    if not "promoted" in event.content:
+        return None
+    actions.joined.pop(event.content['promoted'], None)
+    return event.author+' has promoted '+event.content['promoted']+"."
+
+@handles('demote')
+def on_demote(event, actions):
+    if not "demoted" in event.content:
+        return None
+    return event.author+' has demoted '+event.content['demoted']+"."
+
+@handles('boot')
+def on_boot(event, actions):
+    return event.author+' has booted '+event.content['booted']+"."
+
+@handles('friendly_match')
+def on_friendly_match(event, actions):
+    return None
+    #return event.author+' started a friendly match.'
+
+def relay_events(chat, channel, cursor, messages, actions):
+    # hands the new messages to discord, returns how many there were
+    colour = int(chat.get('colour', '0xffffff'), 16)
+    outbox = outbox_for(channel, chat)
+    handled = 0
+    for message in cursor.new(messages):
+        cursor.handled(message)
+        handled += 1
+        event = bot.ChatEvent(message)
+        text = event_handlers.get(event.type, on_chat)(event, actions)
+        if event.type in ROSTER_EVENTS:
+            actions.roster_changed = True
+        if text:
+            # use webhook for impersonation, delivered in the background
+            outbox.put(event.author, text, colour, event.date)
+    return handled
+
+async def check_chat(chat):
+    player_info = None
+    team_info = None
+
+    logger.info("Checking "+chat['name'])
+    team_id = chat['teamid']
+    roster = roster_for(team_id)
+    if await account_in_use(chat):
+        logger.info("Player is online, skipping")
+        return
+
+    channel = await get_channel(chat)
+    if not channel:
+        logger.error("Could not retrieve channel id "+chat['channel'])
+        return
+
+    # login main account
+    session = session_for(chat)
+    player_info = await connect_as(session)
+    logger.info("Logged in as "+player_info["playerId"])
+
+    if not player_info['sessionId']:
+        logger.error("Could not log in as "+chat['name'])
+        return
+
+    authenticated = 'playerId' in player_info
+    if not authenticated:
+        logger.error("Could not authenticate.")
+        return
+
+    logger.info("CHECK")
+
+    # in push mode the new messages are already here, otherwise poll for them
+    connection = rtt_connections.get(chat['name'])
+    push_mode = connection is not None and connection.connected and connection.synced
+    synced = connection is not None and connection.connected
+    if not push_mode:
+        pushed.pop(team_id, None)
+
+    cursor = cursor_for(team_id)
+    messages = None
+    if push_mode:
+        messages = pushed.pop(team_id, [])
+    else:
+        try:
+            recent = await bot.async_get_team_chat(team_id, session, bot.CHAT_WINDOW)
+        except bot.BrainCloudError:
+            recent = None
+        if recent is not None:
+            messages = await bot.async_fill_chat_gap(team_id, cursor, recent, bot.CHAT_WINDOW, session)
+        else:
+            messages = (await bot.async_channel_connect(team_id, session=session)).get("messages", [])
+    if synced:
+        connection.synced = True
+
+    actions = TeamActions()
+    # the cursor only moves on together with the posts and welcomes it implies
+    with journal.transaction():
+        handled = relay_events(chat, channel, cursor, messages, actions)
+        welcomes = [] if chat.get('read_only') else list(actions.joined.values())
+        for pid in welcomes:
+            queue_event(chat['channel'], 'welcome', pid)
+        if handled:
+            journal.set(['chat_cursor', team_id], cursor.dump())
+    if actions.roster_changed:
+        roster.invalidate()
+    if welcomes:
+        worker_for(chat).wake()
+
+    logger.info("Finished checking "+chat['name'])
+    return handled
+
+# == watchdog =======================================================================
+# Every team check runs as a task of its own. The watchdog looks at them on every
+# tick and cancels a check that has been running for longer than TEAM_DEADLINE,
+# logging the brainCloud call it was waiting for; the other teams carry on. Only
+# a check that ignores being cancelled for STUCK_AFTER seconds makes the relay
+# restart itself.
+
+team_limit = asyncio.Semaphore(MAX_CONCURRENT_TEAMS)
+# team name -> {'task', 'started', 'cancelled'}
+team_runs = {}
+restarting = False
+
+def spawn_team(chat):
+    # a team already being checked picks up pushed messages when it is done
+    if chat['name'] in team_runs:
+        return
+    run = {'task': None, 'started': None, 'cancelled': None}
+    team_runs[chat['name']] = run
+    run['task'] = asyncio.ensure_future(run_team(chat, run))
+
+async def run_team(chat, run):
+    activity = None
+    try:
+        async with team_limit:
+            run['started'] = time.time()
+            activity = await check_chat(chat)
+    except asyncio.CancelledError:
+        logger.error("Checking {} was cancelled.".format(chat['name']))
+    except Exception:
+        logger.exception("Checking {} failed.".format(chat['name']))
+    finally:
+        del team_runs[chat['name']]
+        schedule.done(chat, activity)
+        keep_sessions()
+    # messages pushed during a completed check are handled right away
+    if activity is not None and pushed.get(chat['teamid']):
+        spawn_team(chat)
+
+def in_flight(name):
+    calls = []
+    if name in sessions and sessions[name].current_call():
+        calls.append(sessions[name].current_call())
+    if checker_session.current_call():
+        calls.append("checker: "+checker_session.current_call())
+    return "; ".join(calls) or "no brainCloud call"
+
+async def watchdog():
+    global restarting
+    now = time.time()
+    for name, run in list(team_runs.items()):
+        if run['started'] is None:
+            continue
+        if run['cancelled'] is None and now-run['started'] > TEAM_DEADLINE:
+            logger.error("Checking {} takes longer than {}s, cancelling it. Waiting for: {}".format(name, TEAM_DEADLINE, in_flight(name)))
+            run['cancelled'] = now
+            run['task'].cancel()
+        elif run['cancelled'] is not None and now-run['cancelled'] > STUCK_AFTER and not restarting:
+            logger.error("Checking {} did not stop within {}s of being cancelled, restarting. Waiting for: {}".format(name, STUCK_AFTER, in_flight(name)))
+            restarting = True
+            journal.sync()
+            keep_sessions()
+            await asyncio.create_subprocess_exec("systemctl", "restart", "gb-relay")
+
+# get chat messages
+@tasks.loop(seconds=POLL_TICK)
+async def check_chats():
+    # group-commit whatever was journaled since the last tick
+    journal.sync()
+    await watchdog()
+    expire_notifications()
+
+    idle = [chat for chat in settings.get('chats') if chat['name'] not in team_runs]
+    chats = schedule.due_chats(idle)
+
+    # runs even without due teams, for the teams with pending notifications
+    try:
+        await asyncio.wait_for(probe_presence(chats), timeout=TEAM_DEADLINE)
+    except asyncio.TimeoutError:
+        logger.error("Presence probe took longer than {}s. Waiting for: checker: {}".format(TEAM_DEADLINE, checker_session.current_call()))
+    if not chats:
+        return
+    logger.info("Starting checks of {} teams".format(len(chats)))
+    for chat in chats:
+        spawn_team(chat)
+
+if __name__=="__main__":
+    client.run(settings.get('token'))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Runs the push path end to end without brainCloud or Discord: starts the fake
+# RTT server of fake-rtt.py, connects a botv2.RttConnection to it, posts one chat
+# message into a team channel and hands what is pushed to the relay's
+# relay_events, which posts it to a channel that prints instead. Run it next to
+# the relay's .settings.
+#
+#   ./rtt-demo.py [teamid]
+#
+# Importing the relay opens its state journal, which compacts .state, so the
+# demo copies the configuration into a temporary directory and runs there; a
+# relay running next to it keeps its journal.
+
+import os
+import sys
+import shutil
+import asyncio
+import tempfile
+import importlib.util
+from aiohttp import web
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PORT = 8766
+
+workdir = tempfile.mkdtemp(prefix="rtt-demo-")
+for name in (".settings", "teamoverrides.json", "cardconfig.json"):
+    shutil.copy(name, workdir)
+with open(os.path.join(workdir, ".state"), "w") as fd:
+    fd.write("{}")
+os.chdir(workdir)
+sys.path.insert(0, HERE)
+
+import botv2 as bot
+
+def load(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+fake_rtt = load("fake_rtt", os.path.join(HERE, "fake-rtt.py"))
+relay = load("gb_relay", os.path.join(HERE, "gb-relay-v2.py"))
+
+class PrintWebhook:
+    def __init__(self, name, relayed):
+        self.name = name
+        self.relayed = relayed
+
+    async def send(self, embeds, username):
+        for embed in embeds:
+            print("{}: {}".format(username, embed.description))
+        self.relayed.set()
+
+class PrintChannel:
+    # just enough of a discord channel for relay.get_webhook
+    def __init__(self, id, relayed):
+        self.id = id
+        self.hook = PrintWebhook("gb-"+str(id), relayed)
+
+    async def webhooks(self):
+        return [self.hook]
+
+async def main(team_id):
+    runner = web.AppRunner(fake_rtt.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, "localhost", PORT).start()
+
+    relayed = asyncio.Event()
+    chat = {'name': 'rtt-demo', 'teamid': team_id, 'channel': '0'}
+    channel = PrintChannel(0, relayed)
+    cursor = bot.ChatCursor()
+    def on_message(teamId, message):
+        relay.relay_events(chat, channel, cursor, [message], relay.TeamActions())
+
+    connection = bot.RttConnection(bot.Session(), [team_id], on_message, "ws://localhost:{}/".format(PORT))
+    task = asyncio.ensure_future(connection.run())
+    try:
+        while not connection.connected:
+            await asyncio.sleep(0.1)
+        url = "http://localhost:{}/chat/{}".format(PORT, team_id)
+        async with bot.get_aio_session().post(url, json={"name": "Tester", "msg": "hello"}) as r:
+            print("pushed to {} connections".format((await r.json())["delivered"]))
+        await asyncio.wait_for(relayed.wait(), timeout=10)
+    finally:
+        task.cancel()
+        await bot.async_close()
+        await runner.cleanup()
+
+if __name__=="__main__":
+    try:
+        asyncio.get_event_loop().run_until_complete(main(sys.argv[1] if len(sys.argv) > 1 else "demo-team"))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import contextlib
+
+# Write-ahead journal for the relay state.
+#
+# The snapshot file (.state) is only rewritten on compaction. In between, every
+# change is appended to <snapshot>.journal as one short json line, so a write
+# costs O(change) instead of O(state). Appends are flushed right away and
+# fsynced in groups: after sync_every records, or once sync_interval seconds
+# have passed. compact() writes a fresh snapshot next to the old one, swaps it
+# in atomically and empties the journal. load() replays the journal over the
+# snapshot, ignoring a torn last line left behind by a crash, and compacts.
+# Every record carries a sequence number and the snapshot the number of the
+# last record it contains (as "_journal_seq"), so records a snapshot already
+# covers are skipped if a crash left them in the journal after a compaction.
+#
+# Changes made inside "with journal.transaction():" are written as one record
+# when the block ends, so they are replayed all together or not at all.
+
+class StateJournal:
+    def __init__(self, path, sync_every=20, sync_interval=1.0, compact_every=1000):
+        self.path = path
+        self.journal_path = path+".journal"
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_every = compact_every
+        self.state = {}
+        self.fd = None
+        self.unsynced = 0
+        self.synced_at = time.time()
+        self.records = 0
+        self.pending = None
+        self.seq = 0
+
+    def load(self):
+        self.state = json.load(open(self.path, 'r'))
+        self.seq = self.state.pop('_journal_seq', 0)
+        if os.path.exists(self.journal_path):
+            for line in open(self.journal_path, 'r'):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if record.get('seq', self.seq+1) <= self.seq:
+                    continue
+                self.replay(record)
+                self.seq = record.get('seq', self.seq)
+        self.fd = open(self.journal_path, 'a')
+        self.compact()
+        return self.state
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.pending = []
+        try:
+            yield self
+        except BaseException:
+            self.pending = None
+            raise
+        records, self.pending = self.pending, None
+        if records:
+            self.write({'op': 'batch', 'records': records})
+
+    def container(self, path):
+        node = self.state
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        return node
+
+    def apply(self, record):
+        path = record['path']
+        node = self.container(path)
+        if record['op'] == 'set':
+            node[path[-1]] = record['value']
+        elif record['op'] == 'append':
+            node.setdefault(path[-1], []).append(record['value'])
+        elif record['op'] == 'remove':
+            node.pop(path[-1], None)
+
+    def replay(self, record):
+        if record['op'] == 'batch':
+            for change in record['records']:
+                self.apply(change)
+        else:
+            self.apply(record)
+
+    def write(self, record):
+        if self.pending is not None:
+            self.pending.append(record)
+            return
+        self.replay(record)
+        self.seq += 1
+        record['seq'] = self.seq
+        self.fd.write(json.dumps(record)+"\n")
+        self.fd.flush()
+        self.unsynced += 1
+        self.records += 1
+        if self.unsynced >= self.sync_every or time.time()-self.synced_at >= self.sync_interval:
+            self.sync()
+        if self.records >= self.compact_every:
+            self.compact()
+
+    def set(self, path, value):
+        self.write({'op': 'set', 'path': path, 'value': value})
+
+    def append(self, path, value):
+        self.write({'op': 'append', 'path': path, 'value': value})
+
+    def remove(self, path):
+        self.write({'op': 'remove', 'path': path})
+
+    def sync(self):
+        if self.unsynced:
+            os.fsync(self.fd.fileno())
+        self.unsynced = 0
+        self.synced_at = time.time()
+
+    def compact(self):
+        fd = open(self.path+".tmp", 'w')
+        fd.write(json.dumps(dict(self.state, _journal_seq=self.seq), indent=2))
+        fd.flush()
+        os.fsync(fd.fileno())
+        fd.close()
+        os.replace(self.path+".tmp", self.path)
+        self.fd.close()
+        self.fd = open(self.journal_path, 'w')
+        self.unsynced = 0
+        self.synced_at = time.time()
+        self.records = 0
+
+    def close(self):
+        self.compact()
+        self.fd.close()